@@ -1,83 +1,301 @@
 import pandas as pd
 import numpy as np
-import yfinance as yf
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+import backtest
+import db
+import price_panel
+import price_store
+import reference_data
+import risk_stats
+import rolling_stats
+import monte_carlo
+import result_cache
+import metrics
+import ticker_universe
 
 load_dotenv()
 
-# Access databse environment variables
-db_user = os.getenv('DB_USER')
-db_password = os.getenv('DB_PASSWORD')
-db_host = os.getenv('DB_HOST')
-db_port = os.getenv('DB_PORT')
-db_name = os.getenv('DB_NAME')
-
-engine = create_engine(f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}')
+# Portfolios with more tickers than this use calculate_large_key_figures
+large_universe_threshold = int(os.getenv('LARGE_UNIVERSE_THRESHOLD', 500))
 
 def get_raw_price_data(tickers:list) -> (pd.DataFrame, set):
-    # ACWI or All Country Wide Index is an index with global equity exposure
-    # and used here as the market
-    tickers.append('ACWI')
-    prices5y = yf.download(tickers=tickers, period='5y')
-    prices = prices5y['Adj Close'].dropna(axis=1, how='all').dropna(axis=0)
+    # Served from the shared price panel over the local price store, which
+    # only downloads missing dates. The market series is held in memory by
+    # the reference data service.
+    prices = price_panel.get_adj_close(tickers)
+    prices = pd.concat([prices, reference_data.get_market().rename('Market')], axis=1)
+    prices = prices.dropna(axis=1, how='all').dropna(axis=0)
     not_found_tickers = set(tickers).difference(set(prices.columns))
-    prices.rename(columns={'ACWI':'Market'}, inplace = True)
 
     if all(ticker in prices.columns for ticker in tickers):
         return prices, not_found_tickers
     else:
         return prices, not_found_tickers
 
-def calculate_key_figures(contribution:pd.Series) -> (pd.DataFrame, set):
-    prices, not_found_tickers = get_raw_price_data(contribution.index.tolist())
+def young_tickers(tickers:list) -> dict:
+    """
+    Returns the first trading date of every ticker that started trading
+    within the history window, so that the dates all tickers traded, which
+    the backtest and the portfolio's rolling statistics use, only start from
+    the latest of them. Dates come from the ticker universe, or for tickers it
+    does not date, from the first close in the price store.
+    """
+    window_start = pd.Timestamp.now().normalize() - pd.DateOffset(years=price_store.history_years)
+    first_dates = {}
+    undated = []
+    for ticker in dict.fromkeys(tickers):
+        symbol = ticker_universe.lookup(ticker)
+        if symbol is not None and symbol['first_trading_date'] is not None:
+            first_dates[ticker] = symbol['first_trading_date']
+        else:
+            undated.append(ticker)
+
+    # The store is read directly, this runs in the synchronous add asset
+    # callback and must not wait for a refresh of the shared panel
+    for ticker in undated:
+        first_date = price_store.first_trading_date(ticker)
+        if first_date is not None:
+            first_dates[ticker] = first_date
+    return {ticker: first_date for ticker, first_date in first_dates.items() if first_date > window_start}
+
+def ticker_exists(ticker:str) -> bool:
+    """
+    Returns whether the ticker is in the ticker universe, or otherwise whether
+    Yahoo Finance has prices for it, which are then kept in the price store.
+    Without a universe every ticker is accepted and left for the download to
+    find.
+    """
+    if ticker_universe.is_known(ticker):
+        return True
+    if not ticker:
+        return False
+    price_store.update_store([ticker])
+    return price_store.modified_at(ticker) is not None
+
+def calculate_asset_figures(mean_daily_returns:pd.Series, covariance_matrix:pd.DataFrame, risk_free_rate:float) -> pd.DataFrame:
+    """
+    Returns historical return, volatility, beta and CAPM expected return of
+    every asset from its mean daily return and daily covariances, including
+    the Market.
+    """
     # One month historcal volatility using 21 trading days per month
-    daily_returns = prices.pct_change().dropna()
+    variances = pd.Series(np.diag(covariance_matrix), index=covariance_matrix.index)
     vol_scale_1mo= np.sqrt(21)
-    historical_volatility_1mo =  daily_returns.std() * vol_scale_1mo
+    historical_volatility_1mo =  np.sqrt(variances) * vol_scale_1mo
 
     # Capital Asset Pricing Model
-    risk_free_rate = yf.download('^IRX', period='1mo')['Adj Close'].values[-1] / 100
-    mean_daily_returns = daily_returns.mean()
     mean_annual_returns = (1 + mean_daily_returns)**252 - 1
-    returns_correlation_matrix = daily_returns.corr()
-    betas = returns_correlation_matrix['Market'] * ( daily_returns.var() / daily_returns['Market'].var())
+    market_correlations = covariance_matrix['Market'] / np.sqrt(variances * variances['Market'])
+    betas = market_correlations * ( variances / variances['Market'])
     expected_returns = risk_free_rate + betas * (mean_annual_returns['Market'] - risk_free_rate)
 
-    contribution = contribution[~contribution.index.isin(not_found_tickers)]
+    return pd.DataFrame({
+        'historical_return': mean_annual_returns,
+        'historical_volatility': historical_volatility_1mo,
+        'beta': betas,
+        'expected_return': expected_returns,
+        'risk_free_rate': risk_free_rate,
+    })
+
+def _stack_key_figures(contributions:pd.DataFrame, mean_daily_returns:pd.Series, covariance_matrix:pd.DataFrame, risk_free_rate:float) -> pd.DataFrame:
+    """
+    Returns the key figures of every portfolio of contributions from the same
+    moments, stacked under a (portfolio_id, ticker) index.
+    """
+    asset_figures = calculate_asset_figures(mean_daily_returns, covariance_matrix, risk_free_rate)
+
+    tickers = covariance_matrix.columns.drop('Market')
+    contributions = contributions.reindex(columns=tickers)
+    amounts = contributions.fillna(0)
+    weights = amounts.div(amounts.sum(axis=1), axis=0)
+
+    # Asset rows, one per held ticker of each portfolio
+    held = contributions.stack().dropna()
+    held.index.names = ['portfolio_id', 'ticker']
+    asset_rows = asset_figures.loc[held.index.get_level_values('ticker')].set_index(held.index)
+    asset_rows['weight'] = weights.stack().loc[held.index].values
+    asset_rows['amount'] = held
+
+    # Portfolio rows as weighted sums over all portfolios at once
+    weight_matrix = weights.values
+    portfolio_variances = np.einsum('ij,jk,ik->i', weight_matrix, covariance_matrix.loc[tickers, tickers].values, weight_matrix)
+    portfolio_rows = pd.DataFrame({
+        'historical_return': weight_matrix @ asset_figures.loc[tickers, 'historical_return'].values,
+        'historical_volatility': np.sqrt(portfolio_variances)*np.sqrt(21),
+        'beta': weight_matrix @ asset_figures.loc[tickers, 'beta'].values,
+        'expected_return': weight_matrix @ asset_figures.loc[tickers, 'expected_return'].values,
+        'risk_free_rate': risk_free_rate,
+        'weight': 1.0,
+        'amount': amounts.sum(axis=1).values
+    }, index=pd.MultiIndex.from_product([contributions.index, ['Portfolio']], names=['portfolio_id', 'ticker']))
+    return pd.concat([asset_rows, portfolio_rows])
+
+def calculate_batch_key_figures(contributions:pd.DataFrame) -> (pd.DataFrame, set):
+    """
+    Calculates the key figures of many portfolios at once. contributions has
+    one row of purchase amounts per portfolio and one column per ticker in the
+    union of the portfolios, with NaN where a portfolio does not hold a ticker.
+
+    Returns the key_figures frames of calculate_key_figures stacked under a
+    (portfolio_id, ticker) index. Every portfolio is measured over the dates
+    all its tickers and the Market traded, as in get_raw_price_data. Mean
+    returns and covariances are read once for the whole batch from the
+    incrementally updated risk statistics, and only portfolios holding a
+    ticker that did not trade on exactly the Market's dates are calculated
+    from their prices.
+    """
+    with metrics.span('statistics'):
+        mean_daily_returns, covariance_matrix, not_found_tickers, ragged_tickers = risk_stats.get_moments(contributions.columns.tolist())
+    metrics.count('not_found_tickers', len(not_found_tickers))
+    risk_free_rate = reference_data.get_risk_free_rate()
+
+    ragged = contributions[list(ragged_tickers)].notna().any(axis=1)
+    frames = []
+    if not ragged.all():
+        frames.append(_stack_key_figures(contributions[~ragged], mean_daily_returns, covariance_matrix, risk_free_rate))
+    for portfolio_id, amounts in contributions[ragged].iterrows():
+        tickers = amounts.dropna().index.difference(list(not_found_tickers), sort=False).tolist()
+        with metrics.span('statistics'):
+            portfolio_moments = risk_stats.get_common_moments(tickers)
+        frames.append(_stack_key_figures(contributions.loc[[portfolio_id]], *portfolio_moments, risk_free_rate))
+
+    key_figures = pd.concat(frames).sort_index(level='portfolio_id', sort_remaining=False)
+    return key_figures, not_found_tickers
+
+def calculate_large_key_figures(contribution:pd.Series, dtype=np.float32, chunk_size:int=256) -> (pd.DataFrame, set):
+    """
+    Calculates the key figures of calculate_key_figures for universes of
+    thousands of tickers. Betas only need each ticker's covariance with the
+    Market, and the portfolio volatility is the standard deviation of the
+    weighted daily return series, so no correlation or covariance matrix is
+    built. Returns are processed chunk_size columns at a time in dtype, with
+    means and variances accumulated in float64.
+
+    Like calculate_batch_key_figures, everything is measured over the dates
+    all the tickers and the Market traded, so both agree with the full matrix
+    formulas over the same price history to an absolute tolerance of 1e-5
+    with float32 and 1e-12 with float64, see benchmark.py --check.
+    """
+    # Prices are read as views into the shared panel and only copied a chunk
+    # at a time, on the dates every ticker and the Market traded
+    dates, columns = price_panel.get_columns(contribution.index.tolist())
+    market_prices = reference_data.get_market().reindex(dates).to_numpy(np.float64)
+    traded = ~np.isnan(market_prices)
+    for ticker, column in list(columns.items()):
+        missing = np.isnan(column)
+        if missing.all():
+            del columns[ticker]
+        else:
+            traded &= ~missing
+    not_found_tickers = set(contribution.index).difference(columns)
+    metrics.count('not_found_tickers', len(not_found_tickers))
+    risk_free_rate = reference_data.get_risk_free_rate()
+    tickers = pd.Index(list(columns))
+    contribution = contribution[tickers]
     weights = contribution / contribution.sum()
 
+    market_prices = market_prices[traded]
+    market_returns = market_prices[1:] / market_prices[:-1] - 1
+    market_centered = (market_returns - market_returns.mean()).astype(dtype)
+    market_variance = market_returns.var(ddof=1)
+    n_days = len(market_returns)
+
+    mean_daily_returns = np.empty(len(tickers))
+    variances = np.empty(len(tickers))
+    market_covariances = np.empty(len(tickers))
+    portfolio_returns = np.zeros(n_days)
+    with metrics.span('statistics'):
+        for start in range(0, len(tickers), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            chunk_prices = np.empty((len(market_prices), len(tickers[chunk])), dtype)
+            for j, ticker in enumerate(tickers[chunk]):
+                chunk_prices[:, j] = columns[ticker][traded]
+            returns = chunk_prices[1:] / chunk_prices[:-1] - 1
+            means = returns.mean(axis=0, dtype=np.float64)
+            centered = returns - means.astype(dtype)
+            mean_daily_returns[chunk] = means
+            variances[chunk] = np.square(centered).sum(axis=0, dtype=np.float64) / (n_days - 1)
+            market_covariances[chunk] = market_centered @ centered / (n_days - 1)
+            portfolio_returns += returns @ weights.values[chunk].astype(dtype)
+
+    # Same formulas as calculate_asset_figures, one value per ticker
+    mean_annual_returns = (1 + mean_daily_returns)**252 - 1
+    market_annual_return = (1 + market_returns.mean())**252 - 1
+    market_correlations = market_covariances / np.sqrt(variances * market_variance)
+    betas = market_correlations * (variances / market_variance)
+    expected_returns = risk_free_rate + betas * (market_annual_return - risk_free_rate)
+
     key_figures = pd.DataFrame({
         'historical_return': mean_annual_returns,
-        'historical_volatility': historical_volatility_1mo,
+        'historical_volatility': np.sqrt(variances) * np.sqrt(21),
         'beta': betas,
         'expected_return': expected_returns,
-        'risk_free_rate': [risk_free_rate] * len(prices.columns),
-        'weight': weights,
-        'amount': contribution
-    })
-    key_figures = key_figures.drop(index='Market')
-
-    # Portfolio values
-    daily_returns_no_market = daily_returns.loc[:, daily_returns.columns !='Market']
-    covariance_matrix = daily_returns_no_market.cov()
-    portfolio_historical_returns = (key_figures['historical_return'] * weights).sum()
-    portfolio_historical_volatility = np.sqrt(weights.T.dot(covariance_matrix).dot(weights))*np.sqrt(21)
-    portfolio_beta = (key_figures['beta'] * weights).sum()
-    portfolio_expected_returns = (key_figures['expected_return'] * weights).sum()
-    
+        'risk_free_rate': risk_free_rate,
+        'weight': weights.values,
+        'amount': contribution.values
+    }, index=tickers)
     key_figures.loc['Portfolio'] = {
-        'historical_return': portfolio_historical_returns,
-        'historical_volatility': portfolio_historical_volatility,
-        'beta': portfolio_beta,
-        'expected_return': portfolio_expected_returns,
+        'historical_return': (key_figures['historical_return'] * weights).sum(),
+        'historical_volatility': np.sqrt(portfolio_returns.var(ddof=1))*np.sqrt(21),
+        'beta': (key_figures['beta'] * weights).sum(),
+        'expected_return': (key_figures['expected_return'] * weights).sum(),
         'risk_free_rate': risk_free_rate,
         'weight': 1.0,
         'amount': contribution.sum()
     }
     return key_figures, not_found_tickers
 
+def calculate_key_figures(contribution:pd.Series) -> (pd.DataFrame, set):
+    """
+    Returns the key figures of one portfolio and the tickers that could not be
+    found. Portfolios of more than large_universe_threshold tickers use
+    calculate_large_key_figures, which gives the same figures within float32
+    precision.
+    """
+    if len(contribution) > large_universe_threshold:
+        return calculate_large_key_figures(contribution)
+    key_figures, not_found_tickers = calculate_batch_key_figures(contribution.to_frame('portfolio').T)
+    return key_figures.loc['portfolio'].rename_axis(None), not_found_tickers
+
+def calculate_backtest(amounts:pd.Series, schedules:dict=backtest.schedules) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame):
+    """
+    Returns the values, drawdowns and summary of backtest.backtest_portfolio
+    for the purchase amounts over the price history of get_raw_price_data,
+    or None if none of the tickers were found.
+    """
+    prices, _ = get_raw_price_data(amounts.index.tolist())
+    prices = prices.drop(columns='Market')
+    if prices.empty:
+        return None
+    with metrics.span('backtest'):
+        return backtest.backtest_portfolio(prices, amounts[prices.columns], schedules)
+
+def calculate_rolling_stats(amounts:pd.Series) -> pd.DataFrame:
+    """
+    Returns the rolling statistics of rolling_stats.get_rolling_stats for the
+    tickers of the purchase amounts, and for the portfolio under the
+    'Portfolio' label, all over the Market dates of the history window.
+    Portfolio returns are the weighted daily returns of the prices the asset
+    statistics are measured on, carried forward over the Market dates a
+    ticker did not trade, so the portfolio only has statistics from the date
+    every ticker traded on. Returns None if none of the tickers were found.
+    """
+    with metrics.span('statistics'):
+        assets = rolling_stats.get_rolling_stats(amounts.index.tolist())
+        tickers = assets.columns.get_level_values(0).unique()
+        if tickers.empty:
+            return None
+        prices = rolling_stats.aligned_prices(tickers.tolist())
+        returns = prices.to_numpy()[1:] / prices.to_numpy()[:-1] - 1
+        portfolio_returns = returns[:, 1:] @ (amounts[tickers] / amounts[tickers].sum()).to_numpy()
+        portfolio = {}
+        for window, moments in rolling_stats.rolling_moments(portfolio_returns[:, None], returns[:, 0]).items():
+            for statistic, values in zip(rolling_stats.statistics, moments):
+                portfolio[('Portfolio', f'{statistic}_{window}')] = np.concatenate([[np.nan], values[:, 0]])
+    portfolio = pd.DataFrame(portfolio, index=prices.index).reindex(assets.index)
+    return pd.concat([portfolio, assets], axis=1)
+
 def calculate_expected_returns(currentPrice, expectedReturn, volatility, periodLenghtInYears, z) -> (np.ndarray, np.ndarray, np.ndarray):
     """
     Returns the mean, lower bound and higher bound for future prices based on
@@ -97,51 +315,47 @@ def calculate_expected_returns(currentPrice, expectedReturn, volatility, periodL
     confidenceIntervalHigh = np.exp(futurePricesLn + confidenceIntervalsLn)
     return futurePrices, confidenceIntervalLow, confidenceIntervalHigh
 
-def get_saved_portfolio(portfolio_name:str, session_id:str) -> pd.DataFrame:
-    query = f"""
-        with session_portfolios as (
-        select 
-        portfolio_id,
-        ticker,
-        historical_return,
-        historical_volatility,
-        beta,
-        expected_return,
-        risk_free_rate,
-        weight,
-        amount
-        from portfolio_builder.portfolios
-        where session_id = '{session_id}'
-        ),
-
-        union_portfolios AS (
-            select *
-            from portfolio_builder.example_portfolios
-            union
-            select *
-            from session_portfolios
-        )
+def calculate_simulated_returns(portfolio:pd.DataFrame, periodLenghtInYears, confidenceLevel:float, n_paths:int=20000) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Monte Carlo counterpart of calculate_expected_returns for a key_figures
+    frame. Every asset follows its own geometric Brownian motion with its CAPM
+    expected return, correlated with the other assets through the correlations
+    of their daily returns. Volatilities are on the same scale as the ones
+    calculate_expected_returns is given for the portfolio.
 
-        select *
-        from union_portfolios
-        where portfolio_id = '{portfolio_name}'
-        order by amount asc
+    Returns the median, lower bound and higher bound of the portfolio value
+    for the two-sided confidenceLevel, e.g. 0.9 for the 5th and 95th percentile.
     """
-    return pd.read_sql(query, con=engine)
+    assets = portfolio.drop('Portfolio')
+    with metrics.span('statistics'):
+        _, covariance_matrix, _, ragged_tickers = risk_stats.get_moments(assets.index.tolist())
+        if ragged_tickers.intersection(assets.index):
+            _, covariance_matrix = risk_stats.get_common_moments(assets.index.tolist())
+    covariance_matrix = covariance_matrix.reindex(index=assets.index, columns=assets.index)
+    standard_deviations = np.sqrt(np.diag(covariance_matrix))
+    correlation_matrix = (covariance_matrix / np.outer(standard_deviations, standard_deviations)).fillna(0).values
+    np.fill_diagonal(correlation_matrix, 1)
+    volatilities = assets['historical_volatility'].values
 
-def get_portfolio_names(session_id:str) -> pd.DataFrame:
-    query = f"""
-        with session_portfolios as (
-        select distinct portfolio_id from portfolio_builder.portfolios
-        where session_id = '{session_id}'
+    tail = round((1 - confidenceLevel) / 2 * 100, 6)
+    with metrics.span('simulation'):
+        percentiles = monte_carlo.simulate_portfolio(
+            amounts=assets['amount'].values,
+            expected_returns=assets['expected_return'].values,
+            covariance_matrix=correlation_matrix * np.outer(volatilities, volatilities),
+            periodLenghtInYears=periodLenghtInYears,
+            percentiles=(tail, 50, 100 - tail),
+            n_paths=n_paths
         )
+    return percentiles[50].values, percentiles[tail].values, percentiles[100 - tail].values
 
-        select distinct portfolio_id from portfolio_builder.example_portfolios
-        union
-        select * from session_portfolios
+def get_saved_portfolio(portfolio_name:str, session_id:str) -> pd.DataFrame:
+    return db.get_saved_portfolio(portfolio_name=portfolio_name, session_id=session_id)
 
-    """
-    return pd.read_sql(query, con=engine)
+def get_portfolio_names(session_id:str) -> pd.DataFrame:
+    return db.get_portfolio_names(session_id=session_id)
+
+PortfolioExistsError = db.PortfolioExistsError
 
 def save_portfolio_to_db(contribution:pd.Series, portfolio_id:str, session_id:str):
     key_figures, not_found_tickers = calculate_key_figures(contribution=contribution)
@@ -150,21 +364,41 @@ def save_portfolio_to_db(contribution:pd.Series, portfolio_id:str, session_id:st
         key_figures.rename(columns={'index': 'ticker'}, inplace=True)
         key_figures.insert(0, 'portfolio_id', portfolio_id)
         key_figures.insert(0, 'session_id', session_id)
-        key_figures.to_sql('portfolios', engine,schema='portfolio_builder', if_exists='append', index=False)
+        # Checked again in the same transaction as the write
+        if db.write_portfolios([key_figures]):
+            raise PortfolioExistsError(portfolio_id)
+        result_cache.invalidate(session_id, portfolio_id)
         return not_found_tickers
     return not_found_tickers
 
+def save_portfolios_to_db(contributions:pd.DataFrame, session_id:str, replace:bool=False) -> (set, set):
+    """
+    Saves many portfolios of a session in one transaction. contributions has
+    one row of purchase amounts per portfolio, indexed by portfolio_id, as in
+    calculate_batch_key_figures. With replace, saved portfolios of the same
+    name are recomputed in place, otherwise they are left as they are.
+
+    Returns the names that were not saved because they already existed, and
+    the tickers that could not be found.
+    """
+    key_figures, not_found_tickers = calculate_batch_key_figures(contributions=contributions)
+    key_figures = key_figures.reset_index()
+    key_figures.insert(0, 'session_id', session_id)
+    # Portfolios without any found ticker are not saved, like in save_portfolio_to_db
+    held = key_figures.groupby('portfolio_id')['ticker'].transform('size') > 1
+    frames = (frame for _, frame in key_figures[held].groupby('portfolio_id', sort=False))
+    skipped_portfolios = {portfolio_id for _, portfolio_id in db.write_portfolios(frames, replace=replace)}
+    for portfolio_id in key_figures.loc[held, 'portfolio_id'].unique():
+        result_cache.invalidate(session_id, portfolio_id)
+    return skipped_portfolios, not_found_tickers
+
 def remove_portfolio_from_db(portfolio_id:str, session_id:str):
-    remove_query = text(f"delete from portfolio_builder.portfolios where portfolio_id = '{portfolio_id}' and session_id = '{session_id}';")
-    with engine.connect() as connection:
-        connection.execute(remove_query)
-        connection.commit()
+    db.remove_portfolio(portfolio_id=portfolio_id, session_id=session_id)
+    result_cache.invalidate(session_id, portfolio_id)
 
 def remove_all_portfolios_from_db(session_id:str):
-    truncate_query = text(f"delete from portfolio_builder.portfolios where session_id = '{session_id}';")
-    with engine.connect() as connection:
-        connection.execute(truncate_query)
-        connection.commit()
+    for portfolio_id in db.remove_all_portfolios(session_id=session_id):
+        result_cache.invalidate(session_id, portfolio_id)
 
 def get_cars_table()-> pd.DataFrame:
-    return pd.read_sql("select * from cars_demo.cars", con=engine)
\ No newline at end of file
+    return db.get_cars_table()
@@ -2,8 +2,12 @@ import dash
 from dash import Dash, html, dcc
 import dash_bootstrap_components as dbc
 
-app = Dash(__name__, prevent_initial_callbacks=False, use_pages=True, external_stylesheets=[dbc.themes.BOOTSTRAP])
+import jobs
+import metrics
+
+app = Dash(__name__, prevent_initial_callbacks=False, use_pages=True, external_stylesheets=[dbc.themes.BOOTSTRAP], background_callback_manager=jobs.background_manager)
 application = app.server
+metrics.instrument(app)
 app.layout = html.Div([
     dbc.NavbarSimple(
         children=[
@@ -0,0 +1,20 @@
+// Picks the prebuilt figures of the cars demo in the browser, so that moving
+// the year slider or changing the car type does not call the server.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    cars: {
+        pieCharts: function(year, figures) {
+            const pieCharts = figures && figures.pie_charts[String(year)];
+            if (!pieCharts) {
+                return [window.dash_clientside.no_update, window.dash_clientside.no_update, window.dash_clientside.no_update];
+            }
+            return pieCharts;
+        },
+
+        lineChart: function(selectedType, figures) {
+            if (!figures) {
+                return window.dash_clientside.no_update;
+            }
+            return figures.line_charts[selectedType] || figures.line_charts['All'];
+        }
+    }
+});
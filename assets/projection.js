@@ -0,0 +1,78 @@
+// Draws the projection fan chart of pf_builder in the browser, so that
+// changing the horizon or the confidence level does not call the server.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    projection: {
+        // Longer horizons are drawn with at most this many points per line
+        maxPoints: 730,
+
+        zScores: {'50%': 0.675, '90%': 1.645, '95%': 1.960, '99%': 2.576},
+
+        // Same day selection as decimate_days in pages/pf_builder.py
+        decimateDays: function(periodLengthInDays) {
+            const step = Math.max(1, Math.ceil(periodLengthInDays / this.maxPoints));
+            const days = [];
+            for (let day = 1; day <= periodLengthInDays; day += step) {
+                days.push(day);
+            }
+            if (days[days.length - 1] !== periodLengthInDays) {
+                days.push(periodLengthInDays);
+            }
+            return days;
+        },
+
+        // Mean, lower bound and higher bound of geometric brownian motion,
+        // as in ETL.calculate_expected_returns
+        lognormalBands: function(params, years, confidence) {
+            const z = this.zScores[confidence];
+            const days = this.decimateDays(Math.floor(years * 365.25));
+            const bands = {days: days, median: [], low: [], high: []};
+            days.forEach(function(day) {
+                const t = day / 365.25;
+                const meanLn = Math.log(params.amount) + t * (params.expected_return - params.volatility ** 2 / 2);
+                const intervalLn = z * params.volatility * Math.sqrt(t);
+                bands.median.push(Math.exp(meanLn));
+                bands.low.push(Math.exp(meanLn - intervalLn));
+                bands.high.push(Math.exp(meanLn + intervalLn));
+            });
+            return bands;
+        },
+
+        fanChart: function(params, years, confidence) {
+            const noUpdate = window.dash_clientside.no_update;
+            if (!params) {
+                return noUpdate;
+            }
+            // Monte Carlo bands are simulated on the server for the horizon
+            // and confidence level they were plotted with
+            let bands = params.bands;
+            if (!bands) {
+                years = parseInt(years);
+                if (!(years > 0) || !(confidence in this.zScores)) {
+                    return noUpdate;
+                }
+                bands = this.lognormalBands(params, years, confidence);
+            } else {
+                confidence = params.confidence;
+            }
+
+            const start = new Date();
+            const x = bands.days.map(function(day) {
+                return new Date(start.getTime() + (day - 1) * 86400000).toISOString();
+            });
+            const xRev = x.slice().reverse();
+            const medianRev = bands.median.slice().reverse();
+            return {
+                data: [
+                    {x: x.concat(xRev), y: bands.low.concat(medianRev), fill: 'toself', fillcolor: 'rgba(100,0,0,0.2)',
+                     line: {color: 'rgba(255,255,255,0)'}, showlegend: false, name: confidence + 'Confidence level', mode: 'lines'},
+                    {x: x.concat(xRev), y: bands.high.concat(medianRev), fill: 'toself', fillcolor: 'rgba(0,100,80,0.2)',
+                     line: {color: 'rgba(255,255,255,0)'}, showlegend: false, name: confidence + 'Confidence level', mode: 'lines'},
+                    {x: x, y: bands.median, line: {color: 'rgb(0,100,80)'}, name: 'Portfolio', mode: 'lines'},
+                    {x: x, y: bands.low, line: {color: 'rgb(200,0,0)'}, name: 'Lower bound', mode: 'lines'},
+                    {x: x, y: bands.high, line: {color: 'rgb(0,200,160)'}, name: 'Upper bound', mode: 'lines'}
+                ],
+                layout: {}
+            };
+        }
+    }
+});
@@ -0,0 +1,36 @@
+// Draws the rolling volatility, beta and correlation of one series of
+// pf_builder in the browser, so that switching between the portfolio and
+// its assets does not call the server.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    rolling: {
+        // Same windows and statistics as rolling_stats.py
+        windows: [21, 63, 252],
+        colors: {21: 'rgb(200,0,0)', 63: 'rgb(0,100,80)', 252: 'rgb(0,0,160)'},
+        panels: [
+            {statistic: 'volatility', title: 'Volatility', axis: 'y', domain: [0.7, 1]},
+            {statistic: 'beta', title: 'Beta', axis: 'y2', domain: [0.36, 0.64]},
+            {statistic: 'correlation', title: 'Correlation', axis: 'y3', domain: [0, 0.3]}
+        ],
+
+        chart: function(data, name) {
+            const noUpdate = window.dash_clientside.no_update;
+            if (!data || !(name in data.series)) {
+                return noUpdate;
+            }
+            const series = data.series[name];
+            const traces = [];
+            const layout = {title: 'Rolling risk of ' + name + ' over 21, 63 and 252 trading days'};
+            this.panels.forEach(function(panel, i) {
+                this.windows.forEach(function(window) {
+                    traces.push({
+                        x: data.dates, y: series[panel.statistic + '_' + window], yaxis: panel.axis, mode: 'lines',
+                        name: window + ' days', legendgroup: String(window), showlegend: i === 0,
+                        line: {color: this.colors[window]}
+                    });
+                }, this);
+                layout[panel.axis === 'y' ? 'yaxis' : 'yaxis' + panel.axis.slice(1)] = {domain: panel.domain, title: panel.title};
+            }, this);
+            return {data: traces, layout: layout};
+        }
+    }
+});
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+# Rebalancing schedules backtested for pf_builder, None for buy-and-hold and
+# otherwise the pandas period the target weights are restored on the first
+# trading day of
+schedules = {'Buy and hold': None, 'Monthly': 'M', 'Quarterly': 'Q'}
+
+def rebalance_days(dates:pd.DatetimeIndex, frequencies:list) -> np.ndarray:
+    """
+    Returns a (schedules, days) mask of the days each schedule rebalances on
+    at the close, the first trading day of every new period. The first day,
+    when the portfolio is bought, counts as a rebalance of every schedule.
+    """
+    mask = np.zeros((len(frequencies), len(dates)), dtype=bool)
+    mask[:, 0] = True
+    for i, frequency in enumerate(frequencies):
+        if frequency is not None and len(dates) > 1:
+            periods = dates.to_period(frequency).asi8
+            mask[i, 1:] = periods[1:] != periods[:-1]
+    return mask
+
+def run(prices:np.ndarray, weights:np.ndarray, rebalance:np.ndarray) -> dict:
+    """
+    Backtests every rebalancing schedule of the rebalance mask at once over
+    the (days, assets) prices, starting from a value of 1 invested at the
+    target weights. Holdings stay fixed between rebalances, so the value on
+    a day is the value at the segment's last rebalance times the weighted
+    price relatives since then, and the values at the rebalances are a
+    cumulative product over them. No step loops over days.
+
+    Returns (schedules, days) arrays of the values, the drawdowns from the
+    running peak and the one-way turnover traded on each day, half the sum
+    of the absolute weight changes.
+    """
+    n_schedules, n_days = rebalance.shape
+    days = np.arange(n_days)
+    # Last rebalance strictly before each day, whose holdings the day is valued with
+    last_rebalance = np.maximum.accumulate(np.where(rebalance, days, 0), axis=1)
+    segment_start = np.concatenate([np.zeros((n_schedules, 1), dtype=np.int64), last_rebalance[:, :-1]], axis=1)
+
+    relatives = prices[None, :, :] / prices[segment_start]
+    growth = relatives @ weights
+    # Value of 1 at each rebalance, carried into the segment it starts
+    value_at_rebalance = np.cumprod(np.where(rebalance, growth, 1.0), axis=1)
+    values = value_at_rebalance[np.arange(n_schedules)[:, None], segment_start] * growth
+
+    drifted_weights = relatives * weights / growth[:, :, None]
+    turnover = np.where(rebalance, np.abs(drifted_weights - weights).sum(axis=2) / 2, 0.0)
+    turnover[:, 0] = 0.0
+    drawdowns = values / np.maximum.accumulate(values, axis=1) - 1
+    return {'values': values, 'drawdowns': drawdowns, 'turnover': turnover}
+
+def backtest_portfolio(prices:pd.DataFrame, amounts:pd.Series, schedules:dict=schedules) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame):
+    """
+    Backtests the purchase amounts of a portfolio over the price history, a
+    frame of the dates every ticker traded, under each of the schedules.
+
+    Returns the value and the drawdown of every schedule by date, and a
+    summary with the total and annual return, maximum drawdown, number of
+    rebalances and annual turnover of each.
+
+    example: values, drawdowns, summary = backtest_portfolio(prices, pd.Series({'AAPL': 100, 'F': 50}))
+    """
+    weights = (amounts / amounts.sum())[prices.columns].to_numpy(np.float64)
+    rebalance = rebalance_days(prices.index, list(schedules.values()))
+    results = run(prices.to_numpy(np.float64), weights, rebalance)
+
+    names = list(schedules)
+    values = pd.DataFrame(results['values'].T * amounts.sum(), index=prices.index, columns=names)
+    drawdowns = pd.DataFrame(results['drawdowns'].T, index=prices.index, columns=names)
+    years = max((prices.index[-1] - prices.index[0]).days / 365.25, 1 / 365.25)
+    total_returns = results['values'][:, -1] - 1
+    summary = pd.DataFrame({
+        'total_return': total_returns,
+        'annual_return': (1 + total_returns)**(1 / years) - 1,
+        'max_drawdown': results['drawdowns'].min(axis=1),
+        'rebalances': rebalance[:, 1:].sum(axis=1),
+        'annual_turnover': results['turnover'].sum(axis=1) / years,
+    }, index=names)
+    return values, drawdowns, summary
@@ -0,0 +1,341 @@
+import os
+import sys
+import shutil
+import json
+import time
+import argparse
+import platform
+import tempfile
+import importlib
+import numpy as np
+import pandas as pd
+
+# Every store the app writes to is kept in a scratch directory, set before
+# the app modules read their configuration
+scratch_dir = os.getenv('BENCHMARK_DIR') or tempfile.mkdtemp(prefix='portfolio-builder-benchmark-')
+keep_scratch_dir = bool(os.getenv('BENCHMARK_DIR'))
+for variable, name in [('PRICE_STORE_DIR', 'price_store'), ('SESSION_STORE_DIR', 'session_store'),
+                       ('RESULT_CACHE_DIR', 'result_cache'), ('BACKGROUND_JOBS_DIR', 'background_jobs'),
+                       ('METRICS_DIR', 'metrics')]:
+    os.environ[variable] = os.path.join(scratch_dir, name)
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+from dash._callback_context import context_value
+from dash._utils import AttributeDict
+
+import ETL as etl
+import db
+import fetcher
+import price_store
+import reference_data
+import result_cache
+import risk_stats
+import session_store
+
+here = os.path.dirname(os.path.abspath(__file__))
+results_path = os.getenv('BENCHMARK_RESULTS', os.path.join(here, 'benchmark_results.json'))
+baseline_path = os.getenv('BENCHMARK_BASELINE', os.path.join(here, 'benchmark_baseline.json'))
+# A case fails when its median is this much slower than in the baseline
+tolerance = float(os.getenv('BENCHMARK_TOLERANCE', 0.25))
+
+# Simulations take seconds per run, so they are only run up to
+# simulated_tickers tickers
+grids = {
+    'full': {'tickers': [5, 50, 200], 'years': [1, 5], 'horizons': [1, 10, 30], 'repeats': 5, 'simulated_tickers': 50},
+    'quick': {'tickers': [5, 50], 'years': [5], 'horizons': [10], 'repeats': 3, 'simulated_tickers': 5},
+}
+
+session_id = 'benchmark'
+
+def _offline(starts:dict):
+    raise RuntimeError('The benchmark runs offline, every price must come from the synthetic panel')
+
+def write_panel(n_tickers:int, years:int, seed:int=0) -> list:
+    """
+    Writes a synthetic price panel of n_tickers correlated geometric Brownian
+    motions over years of business days into the price store, along with the
+    market and risk free rate series, and returns the tickers.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(end=pd.Timestamp.now().normalize(), periods=int(years * 261))
+    market = rng.normal(0.0003, 0.009, len(dates))
+    betas = rng.uniform(0.5, 1.5, n_tickers)
+    returns = market[:, None] * betas + rng.normal(0.0001, 0.012, (len(dates), n_tickers))
+
+    price_store.history_years = years
+    market_prices = pd.Series(100 * np.exp(np.cumsum(market)), index=dates)
+    tickers = [f'SYN{n_tickers}Y{years}N{i:04d}' for i in range(n_tickers)]
+    for i, ticker in enumerate(tickers):
+        price_store.write_ticker(ticker, pd.Series(100 * np.exp(np.cumsum(returns[:, i])), index=dates))
+
+    # The reference data is set directly, refreshing it would download it
+    price_store.write_ticker(reference_data.market_ticker, market_prices)
+    reference_data._market = market_prices
+    reference_data._risk_free_rate = 0.05
+    reference_data._refreshed_at = time.time()
+    reference_data._refresher_pid = os.getpid()
+    # Running sums are rebuilt for the new panel
+    reset_risk_stats()
+    return tickers
+
+def write_ragged_panel(n_tickers:int=40, years:int=2, seed:int=1) -> list:
+    """
+    Writes a panel like write_panel whose tickers do not share the market's
+    dates: some start trading within the window, some miss days and some trade
+    on days the market does not.
+    """
+    tickers = write_panel(n_tickers, years, seed)
+    rng = np.random.default_rng(seed)
+    for i, ticker in enumerate(tickers):
+        prices = price_store.read_ticker(ticker)
+        if i % 4 == 1:
+            prices = prices.iloc[rng.integers(50, len(prices) // 2):]
+        elif i % 4 == 2:
+            prices = prices.drop(prices.index[rng.choice(len(prices), 20, replace=False)])
+        elif i % 4 == 3:
+            extra = prices.index[rng.choice(len(prices), 10, replace=False)] + pd.Timedelta(days=1)
+            extra = extra[extra.dayofweek == 5]
+            prices = pd.concat([prices, pd.Series(prices.mean(), index=extra)]).sort_index()
+        price_store.write_ticker(ticker, prices, replace=True)
+    reset_risk_stats()
+    return tickers
+
+def baseline_key_figures(contribution:pd.Series) -> pd.DataFrame:
+    # The original calculation, over the dates every ticker and the Market traded
+    prices, _ = etl.get_raw_price_data(contribution.index.tolist())
+    daily_returns = prices.pct_change().dropna()
+    mean_annual_returns = (1 + daily_returns.mean())**252 - 1
+    betas = daily_returns.corr()['Market'] * (daily_returns.var() / daily_returns['Market'].var())
+    weights = contribution[prices.columns.drop('Market')] / contribution[prices.columns.drop('Market')].sum()
+    key_figures = pd.DataFrame({
+        'historical_return': mean_annual_returns,
+        'historical_volatility': daily_returns.std() * np.sqrt(21),
+        'beta': betas,
+    }).drop(index='Market')
+    covariance_matrix = daily_returns.drop(columns='Market').cov()
+    key_figures.loc['Portfolio'] = {
+        'historical_return': (key_figures['historical_return'] * weights).sum(),
+        'historical_volatility': np.sqrt(weights.T.dot(covariance_matrix).dot(weights))*np.sqrt(21),
+        'beta': (key_figures['beta'] * weights).sum(),
+    }
+    return key_figures
+
+def check(tolerance:float=1e-5) -> list:
+    """
+    Returns a description of every key figure on which the batch path of
+    calculate_key_figures, calculate_large_key_figures and the original
+    calculation differ by more than tolerance on a ragged panel, for
+    portfolios whose tickers share the market's dates and for ones that do
+    not.
+    """
+    fetcher.fetch_adj_close = _offline
+    tickers = write_ragged_panel()
+    rng = np.random.default_rng(0)
+    portfolios = {
+        'aligned': pd.Series(rng.uniform(50, 150, 10), index=tickers[0::4][:10]),
+        'ragged': pd.Series(rng.uniform(50, 150, len(tickers)), index=tickers),
+    }
+    figures = ['historical_return', 'historical_volatility', 'beta']
+    mismatches = []
+    for name, contribution in portfolios.items():
+        results = {
+            'baseline': baseline_key_figures(contribution),
+            'batch': etl.calculate_batch_key_figures(contribution.to_frame(name).T)[0].loc[name][figures],
+            'large': etl.calculate_large_key_figures(contribution)[0][figures],
+        }
+        for method in ['batch', 'large']:
+            difference = (results[method] - results['baseline'].loc[results[method].index]).abs().max()
+            for figure in figures:
+                if not difference[figure] <= tolerance:
+                    mismatches.append(f'{name} portfolio, {method}: {figure} differs from the baseline by {difference[figure]:.2e}')
+    return mismatches
+
+def reset_risk_stats():
+    risk_stats._state = risk_stats._empty_state()
+    risk_stats._loaded_mtime = None
+    if os.path.exists(risk_stats.stats_path):
+        os.remove(risk_stats.stats_path)
+
+def sqlite_engine(path:str=None) -> object:
+    """
+    Returns a SQLite engine standing in for PostgreSQL, with the
+    portfolio_builder schema attached. The database is kept in memory, or in
+    files next to path when it is shared with other processes.
+    """
+    if path is None:
+        engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+        schema_path = ':memory:'
+    else:
+        engine = create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False, 'timeout': 30})
+        schema_path = f'{path}.portfolio_builder'
+
+    @event.listens_for(engine, 'connect')
+    def _connect(connection, record):
+        connection.execute(f"attach '{schema_path}' as portfolio_builder")
+        connection.create_function('now', 0, lambda: pd.Timestamp.now().isoformat())
+    return engine
+
+def create_database(n_rows:int=20000, path:str=None) -> object:
+    """
+    Returns the engine of sqlite_engine with the portfolio_builder tables and
+    n_rows saved by other sessions.
+    """
+    engine = sqlite_engine(path)
+    columns = 'portfolio_id text, ticker text, historical_return real, historical_volatility real, beta real, expected_return real, risk_free_rate real, weight real, amount real'
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'create table portfolio_builder.example_portfolios ({columns})')
+        connection.exec_driver_sql(f'create table portfolio_builder.portfolios (session_id text, {columns})')
+        connection.exec_driver_sql('create index portfolio_builder.portfolios_session_portfolio_idx on portfolios (session_id, portfolio_id)')
+        connection.exec_driver_sql('create table portfolio_builder.sessions (session_id text primary key, created_at text default current_timestamp, last_used_at text default current_timestamp)')
+    rng = np.random.default_rng(0)
+    filler = pd.DataFrame({
+        'session_id': [f'session-{i // 50}' for i in range(n_rows)],
+        'portfolio_id': [f'portfolio-{i // 10}' for i in range(n_rows)],
+        'ticker': [f'SYN{i % 10:04d}' for i in range(n_rows)],
+        **{column: rng.random(n_rows) for column in ['historical_return', 'historical_volatility', 'beta', 'expected_return', 'risk_free_rate', 'weight', 'amount']},
+    })
+    filler.to_sql('portfolios', engine, schema='portfolio_builder', if_exists='append', index=False)
+    return engine
+
+def save_portfolio(tickers:list, portfolio_id:str):
+    # SQLite has no COPY, so the key figures are appended directly
+    key_figures, _ = etl.calculate_key_figures(pd.Series(100, index=tickers))
+    key_figures = key_figures.reset_index().rename(columns={'index': 'ticker'})
+    key_figures.insert(0, 'portfolio_id', portfolio_id)
+    key_figures.insert(0, 'session_id', session_id)
+    key_figures.to_sql('portfolios', db.engine, schema='portfolio_builder', if_exists='append', index=False)
+    session_store.bump_version(session_id)
+
+def fill_session(tickers:list):
+    session_store.clear(session_id)
+    for ticker in tickers:
+        session_store.add_asset(session_id, ticker, 100)
+
+def triggered(component_id:str):
+    # Callbacks read the pressed button from the Dash callback context
+    context_value.set(AttributeDict(triggered_inputs=[{'prop_id': f'{component_id}.n_clicks', 'value': 1}]))
+
+def time_case(function, repeats:int, setup=None) -> list:
+    """
+    Runs function once to warm up and then repeats times, calling setup
+    before each run outside the timing. Returns the run times in seconds.
+    """
+    timings = []
+    for run in range(repeats + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        if run:
+            timings.append(time.perf_counter() - start)
+    return timings
+
+def run(grid:dict) -> list:
+    """
+    Runs every case of the grid and returns one result per case with its
+    parameters and the median and minimum run time.
+    """
+    fetcher.fetch_adj_close = _offline
+    db.engine = create_database()
+    importlib.import_module('application')
+    pf_builder = sys.modules['pages.pf_builder']
+    no_progress = lambda progress: None
+    repeats = grid['repeats']
+    results = []
+
+    def record(name:str, params:dict, timings:list):
+        results.append({'name': name, 'params': params, 'median_seconds': float(np.median(timings)), 'min_seconds': float(np.min(timings))})
+        print(f"{name:26s} {json.dumps(params):66s} {np.median(timings)*1000:10.2f} ms")
+
+    for years in grid['years']:
+        for n_tickers in grid['tickers']:
+            tickers = write_panel(n_tickers, years)
+            contribution = pd.Series(100, index=tickers)
+            params = {'tickers': n_tickers, 'years': years}
+
+            record('calculate_key_figures', params, time_case(lambda: etl.calculate_key_figures(contribution), repeats))
+            # The first request after the running sums were dropped builds them from the whole window
+            record('calculate_key_figures_cold', params, time_case(lambda: etl.calculate_key_figures(contribution), repeats, reset_risk_stats))
+            record('calculate_backtest', params, time_case(lambda: etl.calculate_backtest(contribution), repeats))
+            record('calculate_rolling_stats', params, time_case(lambda: etl.calculate_rolling_stats(contribution), repeats))
+
+            save_portfolio(tickers, 'saved')
+            clear_session_cache = lambda: db._session_cache.clear()
+            record('get_saved_portfolio', params, time_case(lambda: etl.get_saved_portfolio('saved', session_id), repeats, clear_session_cache))
+
+            fill_session(tickers[:-1])
+            def add_and_delete():
+                triggered('addAssetButton')
+                pf_builder.update_asset_list(1, None, None, session_id, tickers[-1], 100)
+                triggered('deleteAssetButton')
+                pf_builder.update_asset_list(1, 1, None, session_id, tickers[-1], 100)
+            record('update_asset_list', params, time_case(add_and_delete, repeats))
+
+            fill_session(tickers)
+            for horizon in grid['horizons']:
+                horizon_params = {**params, 'horizon': horizon}
+                record('calculate_expected_returns', horizon_params, time_case(lambda: etl.calculate_expected_returns(1000.0, 0.07, 0.05, horizon, 1.645), repeats))
+                methods = ['lognormal', 'monte_carlo'] if n_tickers <= grid['simulated_tickers'] else ['lognormal']
+                for method in methods:
+                    # Cached outputs would hide the work, so every run starts cold
+                    plot = lambda: pf_builder.updatePlot(no_progress, 1, session_id, str(horizon), '90%', 'Current', method)
+                    record('updatePlot', {**horizon_params, 'method': method}, time_case(plot, repeats, result_cache.cache.clear))
+    return results
+
+def case_key(result:dict) -> str:
+    return result['name'] + json.dumps(result['params'], sort_keys=True)
+
+def compare(results:list, baseline:list) -> list:
+    """
+    Returns a description of every case whose median is more than tolerance
+    slower than its baseline. Cases missing from the baseline are skipped.
+    """
+    baseline = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline.get(case_key(result))
+        if reference is not None and result['median_seconds'] > reference['median_seconds'] * (1 + tolerance):
+            regressions.append(f"{result['name']} {json.dumps(result['params'])}: {result['median_seconds']*1000:.2f} ms, baseline {reference['median_seconds']*1000:.2f} ms")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the ETL numerics and the pf_builder callbacks')
+    parser.add_argument('--grid', choices=grids, default='full')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='only check that the key figure paths agree on a ragged panel')
+    arguments = parser.parse_args()
+
+    if arguments.check:
+        try:
+            mismatches = check()
+        finally:
+            if not keep_scratch_dir:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+        for mismatch in mismatches:
+            print(f'MISMATCH {mismatch}')
+        print('Key figure paths agree' if not mismatches else f'{len(mismatches)} mismatches')
+        sys.exit(1 if mismatches else 0)
+
+    try:
+        results = run(grids[arguments.grid])
+    finally:
+        if not keep_scratch_dir:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(), 'grid': arguments.grid, 'results': results}
+    with open(results_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    if arguments.save_baseline:
+        with open(baseline_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Baseline saved to {baseline_path}')
+        sys.exit(0)
+    if not os.path.exists(baseline_path):
+        print(f'No baseline at {baseline_path}, run with --save-baseline to store one')
+        sys.exit(0)
+
+    with open(baseline_path) as file:
+        regressions = compare(results, json.load(file)['results'])
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    sys.exit(1 if regressions else 0)
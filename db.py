@@ -0,0 +1,321 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+import pandas as pd
+from dotenv import load_dotenv
+
+import session_store
+import metrics
+
+load_dotenv()
+
+# Access databse environment variables
+db_user = os.getenv('DB_USER')
+db_password = os.getenv('DB_PASSWORD')
+db_host = os.getenv('DB_HOST')
+db_port = os.getenv('DB_PORT')
+db_name = os.getenv('DB_NAME')
+
+# Every gunicorn worker has its own pool with a connection for each of its
+# threads, see gunicorn.conf.py. Overflow covers the reference data refresher.
+pool_size = int(os.getenv('DB_POOL_SIZE', os.getenv('GUNICORN_THREADS', 4)))
+max_overflow = int(os.getenv('DB_MAX_OVERFLOW', 2))
+
+# Created on first use, so importing this module opens no connection and
+# does not load SQLAlchemy. Under gunicorn --preload the master never uses
+# it and every worker creates its own.
+engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    global engine
+    if engine is None:
+        from sqlalchemy import create_engine
+        with _engine_lock:
+            if engine is None:
+                engine = create_engine(
+                    f'postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}',
+                    pool_size=pool_size,
+                    max_overflow=max_overflow,
+                    pool_pre_ping=True,
+                    pool_recycle=1800,
+                )
+    return engine
+
+def _reset_engine_after_fork():
+    # Forked background jobs must not reuse the connections of the parent
+    global _engine_lock
+    _engine_lock = threading.Lock()
+    if engine is not None:
+        engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_reset_engine_after_fork)
+
+def sql(statement:str):
+    from sqlalchemy import text
+    return text(statement)
+
+# All statements take their values as bound parameters, wrapped with sql()
+# when they are run
+
+# Session lookups use the (session_id, portfolio_id) index, see migrations
+saved_portfolio_query = """
+    select
+    portfolio_id,
+    ticker,
+    historical_return,
+    historical_volatility,
+    beta,
+    expected_return,
+    risk_free_rate,
+    weight,
+    amount
+    from portfolio_builder.portfolios
+    where session_id = :session_id and portfolio_id = :portfolio_id
+"""
+
+portfolio_names_query = """
+    select distinct portfolio_id from portfolio_builder.portfolios
+    where session_id = :session_id
+"""
+
+example_portfolios_query = "select * from portfolio_builder.example_portfolios"
+
+touch_session_statement = """
+    insert into portfolio_builder.sessions (session_id) values (:session_id)
+    on conflict (session_id) do update set last_used_at = now()
+"""
+
+remove_portfolio_query = """
+    delete from portfolio_builder.portfolios
+    where portfolio_id = :portfolio_id and session_id = :session_id
+"""
+
+remove_all_portfolios_query = """
+    delete from portfolio_builder.portfolios
+    where session_id = :session_id
+    returning portfolio_id
+"""
+
+cars_query = "select * from cars_demo.cars"
+
+# Bulk writes go through psycopg2 directly for COPY
+portfolio_columns = ['session_id', 'portfolio_id', 'ticker', 'historical_return', 'historical_volatility', 'beta', 'expected_return', 'risk_free_rate', 'weight', 'amount']
+
+create_staging_statement = """
+    create temporary table portfolios_staging
+    (like portfolio_builder.portfolios including defaults)
+    on commit drop
+"""
+
+copy_staging_statement = f"copy portfolios_staging ({', '.join(portfolio_columns)}) from stdin with (format csv)"
+
+# Taken in a fixed order so that concurrent writers cannot deadlock
+lock_staged_portfolios_statement = """
+    select pg_advisory_xact_lock(hashtext(session_id || '/' || portfolio_id))
+    from (select distinct session_id, portfolio_id from portfolios_staging order by 1, 2) staged
+"""
+
+staged_sessions_statement = "select distinct session_id from portfolios_staging"
+
+touch_staged_sessions_statement = """
+    insert into portfolio_builder.sessions (session_id)
+    select distinct session_id from portfolios_staging
+    on conflict (session_id) do update set last_used_at = now()
+"""
+
+existing_portfolios_statement = """
+    select distinct staged.session_id, staged.portfolio_id
+    from portfolios_staging staged
+    where exists (
+        select 1 from portfolio_builder.portfolios saved
+        where saved.session_id = staged.session_id and saved.portfolio_id = staged.portfolio_id
+    )
+    or exists (
+        select 1 from portfolio_builder.example_portfolios example
+        where example.portfolio_id = staged.portfolio_id
+    )
+"""
+
+drop_existing_from_staging_statement = f"""
+    delete from portfolios_staging staged
+    using ({existing_portfolios_statement}) existing
+    where staged.session_id = existing.session_id and staged.portfolio_id = existing.portfolio_id
+"""
+
+delete_replaced_portfolios_statement = """
+    delete from portfolio_builder.portfolios saved
+    using (select distinct session_id, portfolio_id from portfolios_staging) staged
+    where saved.session_id = staged.session_id and saved.portfolio_id = staged.portfolio_id
+"""
+
+insert_from_staging_statement = f"""
+    insert into portfolio_builder.portfolios ({', '.join(portfolio_columns)})
+    select {', '.join(portfolio_columns)} from portfolios_staging
+"""
+
+class PortfolioExistsError(Exception):
+    """
+    Raised when a portfolio is saved under a name the session already uses.
+    """
+
+# Portfolio names and saved portfolios of the most recently used sessions.
+# Entries are tagged with the session's version in session_store, which
+# every write bumps, so writes made by other workers invalidate them too.
+cached_sessions = int(os.getenv('DB_CACHED_SESSIONS', 1000))
+_cache_lock = threading.Lock()
+_session_cache = OrderedDict()
+# Example portfolios only change when the database is seeded
+examples_refresh_seconds = float(os.getenv('DB_EXAMPLES_REFRESH_SECONDS', 3600))
+_examples = None
+_examples_loaded_at = 0.0
+# Sessions with saved portfolios mark themselves used at most this often,
+# which keeps their data from being purged, see retention.py
+session_touch_seconds = float(os.getenv('DB_SESSION_TOUCH_SECONDS', 300))
+
+def _reset_after_fork():
+    global _cache_lock
+    _cache_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _session_entry(session_id:str) -> dict:
+    version = session_store.get_version(session_id)
+    with _cache_lock:
+        entry = _session_cache.get(session_id)
+        if entry is None or entry['version'] != version:
+            entry = {'version': version, 'names': None, 'portfolios': {}, 'saved': False, 'touched_at': 0.0}
+            _session_cache[session_id] = entry
+        _session_cache.move_to_end(session_id)
+        while len(_session_cache) > cached_sessions:
+            _session_cache.popitem(last=False)
+    return entry
+
+def _touch_session(session_id:str, entry:dict):
+    if entry['saved'] and time.time() - entry['touched_at'] > session_touch_seconds:
+        entry['touched_at'] = time.time()
+        with metrics.span('sql'), get_engine().begin() as connection:
+            connection.execute(sql(touch_session_statement), {'session_id': session_id})
+
+def get_example_portfolios() -> pd.DataFrame:
+    """
+    Returns the example portfolios shared by every session, read from the
+    database at most once every examples_refresh_seconds per worker.
+    """
+    global _examples, _examples_loaded_at
+    if _examples is None or time.time() - _examples_loaded_at > examples_refresh_seconds:
+        with metrics.span('sql'):
+            examples = pd.read_sql(sql(example_portfolios_query), con=get_engine())
+        with _cache_lock:
+            _examples, _examples_loaded_at = examples, time.time()
+    return _examples
+
+def get_saved_portfolio(portfolio_name:str, session_id:str) -> pd.DataFrame:
+    entry = _session_entry(session_id)
+    portfolio = entry['portfolios'].get(portfolio_name)
+    metrics.count('session_cache_miss' if portfolio is None else 'session_cache_hit')
+    if portfolio is None:
+        examples = get_example_portfolios()
+        with metrics.span('sql'):
+            session_rows = pd.read_sql(sql(saved_portfolio_query), con=get_engine(), params={'session_id': session_id, 'portfolio_id': portfolio_name})
+        entry['saved'] = entry['saved'] or not session_rows.empty
+        portfolio = pd.concat([examples[examples['portfolio_id'] == portfolio_name], session_rows])
+        portfolio = portfolio.drop_duplicates().sort_values('amount').reset_index(drop=True)
+        entry['portfolios'][portfolio_name] = portfolio
+    _touch_session(session_id, entry)
+    return portfolio.copy()
+
+def get_portfolio_names(session_id:str) -> pd.DataFrame:
+    entry = _session_entry(session_id)
+    metrics.count('session_cache_miss' if entry['names'] is None else 'session_cache_hit')
+    if entry['names'] is None:
+        examples = get_example_portfolios()
+        with metrics.span('sql'):
+            session_names = pd.read_sql(sql(portfolio_names_query), con=get_engine(), params={'session_id': session_id})
+        entry['saved'] = entry['saved'] or not session_names.empty
+        names = pd.concat([examples[['portfolio_id']], session_names]).drop_duplicates()
+        entry['names'] = names.reset_index(drop=True)
+    _touch_session(session_id, entry)
+    return entry['names'].copy()
+
+class _CsvStream:
+    """
+    File-like object that renders the frames to CSV only as COPY reads them,
+    so a batch never has to be held as one string.
+    """
+    def __init__(self, frames):
+        self.frames = iter(frames)
+        self.buffer = ''
+
+    def read(self, size:int=-1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            frame = next(self.frames, None)
+            if frame is None:
+                break
+            self.buffer += frame[portfolio_columns].to_csv(index=False, header=False)
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+def write_portfolios(frames, replace:bool=False) -> set:
+    """
+    Writes any number of key-figure frames with the portfolio_columns in a
+    single transaction. Rows are streamed through COPY into a temporary
+    staging table and moved into portfolio_builder.portfolios from there.
+
+    With replace, saved portfolios with the same session and name are
+    replaced. Otherwise they are kept, and the (session_id, portfolio_id)
+    pairs that already existed or use an example portfolio name are returned
+    instead of being written.
+    """
+    with metrics.span('sql'):
+        connection = get_engine().raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(create_staging_statement)
+                cursor.copy_expert(copy_staging_statement, _CsvStream(frames))
+                # Concurrent writers of the same portfolios wait for each other
+                cursor.execute(lock_staged_portfolios_statement)
+                cursor.execute(staged_sessions_statement)
+                session_ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute(touch_staged_sessions_statement)
+                if replace:
+                    skipped_portfolios = set()
+                    cursor.execute(delete_replaced_portfolios_statement)
+                else:
+                    cursor.execute(existing_portfolios_statement)
+                    skipped_portfolios = set(cursor.fetchall())
+                    cursor.execute(drop_existing_from_staging_statement)
+                cursor.execute(insert_from_staging_statement)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    for session_id in session_ids:
+        session_store.bump_version(session_id)
+    return skipped_portfolios
+
+def remove_portfolio(portfolio_id:str, session_id:str):
+    with metrics.span('sql'), get_engine().connect() as connection:
+        connection.execute(sql(remove_portfolio_query), {'portfolio_id': portfolio_id, 'session_id': session_id})
+        connection.commit()
+    session_store.bump_version(session_id)
+
+def remove_all_portfolios(session_id:str) -> set:
+    """
+    Removes every portfolio of the session and returns the removed names.
+    """
+    with metrics.span('sql'), get_engine().connect() as connection:
+        removed_portfolio_ids = set(connection.execute(sql(remove_all_portfolios_query), {'session_id': session_id}).scalars())
+        connection.commit()
+    session_store.bump_version(session_id)
+    return removed_portfolio_ids
+
+def get_cars_table() -> pd.DataFrame:
+    with metrics.span('sql'):
+        return pd.read_sql(sql(cars_query), con=get_engine())
@@ -0,0 +1,30 @@
+import os
+import threading
+from contextlib import contextmanager
+import diskcache
+
+# SQLite keeps the locks of all connections to a file in the process, and a
+# forked child inherits them. A background job forked while another thread
+# is inside a transaction would see the cache locked forever, so forks wait
+# for transactions and reads to finish.
+_fork_lock = threading.RLock()
+
+def _reset_after_fork():
+    global _fork_lock
+    _fork_lock = threading.RLock()
+
+os.register_at_fork(before=lambda: _fork_lock.acquire(), after_in_parent=lambda: _fork_lock.release(), after_in_child=_reset_after_fork)
+
+class Cache(diskcache.Cache):
+    """
+    diskcache.Cache that can be used from the threads of a process which
+    forks background jobs.
+    """
+    @contextmanager
+    def _transact(self, retry:bool=False, filename:str=None):
+        with _fork_lock, super()._transact(retry=retry, filename=filename) as transaction:
+            yield transaction
+
+    def get(self, *args, **kwargs):
+        with _fork_lock:
+            return super().get(*args, **kwargs)
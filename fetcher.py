@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+import threading
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, wait
+import pandas as pd
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+history_years = 5
+# At most max_workers tickers are downloaded at the same time by the process
+max_workers = int(os.getenv('FETCH_MAX_WORKERS', 8))
+ticker_timeout_seconds = float(os.getenv('FETCH_TICKER_TIMEOUT_SECONDS', 10))
+deadline_seconds = float(os.getenv('FETCH_DEADLINE_SECONDS', 20))
+retries = int(os.getenv('FETCH_RETRIES', 2))
+backoff_seconds = float(os.getenv('FETCH_BACKOFF_SECONDS', 0.5))
+breaker_threshold = int(os.getenv('FETCH_BREAKER_THRESHOLD', 5))
+breaker_reset_seconds = float(os.getenv('FETCH_BREAKER_RESET_SECONDS', 60))
+
+class CircuitBreaker:
+    """
+    Stops calls to the upstream provider after threshold consecutive failures.
+    After reset_seconds a single trial call is let through, and its outcome
+    either closes the breaker or keeps it open for another period.
+    """
+    def __init__(self, threshold:int, reset_seconds:float):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_seconds and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+breaker = CircuitBreaker(breaker_threshold, breaker_reset_seconds)
+_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='price-fetcher')
+
+def _reset_after_fork():
+    # Threads of the parent do not exist in a forked background job
+    global breaker, _executor
+    breaker = CircuitBreaker(breaker_threshold, breaker_reset_seconds)
+    _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='price-fetcher')
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def download_ticker(ticker:str, start:dt.date=None) -> pd.Series:
+    """
+    Downloads the adjusted closes of one ticker, either from start or for the
+    full history window. yf.Ticker is used instead of yf.download because the
+    latter shares module level state between threads.
+    """
+    # Imported on first download, it is slow to import and not needed at
+    # startup. Gunicorn and the job server import it before serving, see
+    # jobs.deferred_modules.
+    import yfinance as yf
+    with metrics.span('download'):
+        if start is None:
+            history = yf.Ticker(ticker).history(period=f'{history_years}y', auto_adjust=False, timeout=ticker_timeout_seconds)
+        else:
+            history = yf.Ticker(ticker).history(start=start, auto_adjust=False, timeout=ticker_timeout_seconds)
+    if history.empty or 'Adj Close' not in history.columns:
+        return None
+    # Exchanges have their own time zones, so keep only the trading date
+    history.index = history.index.tz_localize(None).normalize()
+    return history['Adj Close'].rename(ticker)
+
+def _fetch_ticker(ticker:str, start:dt.date, deadline:float) -> pd.Series:
+    """
+    Retries failed downloads with exponential backoff as long as the breaker
+    allows calls and the next attempt could still finish before the deadline.
+    An empty result means an unknown ticker and is not retried. A ticker
+    whose turn on the pool only comes after the deadline is skipped.
+    """
+    for attempt in range(retries + 1):
+        if time.monotonic() >= deadline or not breaker.allow():
+            return None
+        try:
+            prices = download_ticker(ticker, start=start)
+            breaker.record_success()
+            return prices
+        except Exception as error:
+            breaker.record_failure()
+            delay = backoff_seconds * 2**attempt
+            if attempt == retries or time.monotonic() + delay + ticker_timeout_seconds > deadline:
+                logger.warning('Could not download %s: %s', ticker, error)
+                return None
+            time.sleep(delay)
+
+def fetch_adj_close(starts:dict) -> pd.DataFrame:
+    """
+    Downloads the tickers in starts concurrently, each from its own start date
+    (None for the full history window). Returns one column per ticker that
+    arrived before the deadline; missing, failed and late tickers are left out.
+    Downloads still queued at the deadline are cancelled, so they do not hold
+    up the tickers of later requests.
+    """
+    deadline = time.monotonic() + deadline_seconds
+    futures = {_executor.submit(_fetch_ticker, ticker, start, deadline): ticker for ticker, start in starts.items()}
+    done, not_done = wait(futures, timeout=deadline_seconds)
+    for future in not_done:
+        future.cancel()
+    columns = {}
+    for future in done:
+        prices = future.result()
+        if prices is not None:
+            columns[futures[future]] = prices
+    return pd.DataFrame(columns)
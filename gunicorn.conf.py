@@ -0,0 +1,34 @@
+import os
+
+# Worker layout, also used to size the database pool of each worker in db.py
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+
+# The app is imported once in the master and forked into the workers, so a
+# worker starts in milliseconds. Importing it opens no connections, see
+# import_budget.py, and every worker creates its own database engine.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+def post_worker_init(worker):
+    # Expired session data is purged from within the workers, see retention.py
+    import retention
+    retention.start_purger()
+    # Background jobs are forked from a server that has imported the app, see
+    # jobs.py. Starting it here keeps that import out of the first request.
+    import jobs
+    jobs.start_server()
+
+def when_ready(server):
+    # One process pool for the simulations of every worker and background
+    # job, see monte_carlo.py. Started before the workers are forked, which
+    # find it through the environment.
+    import monte_carlo
+    monte_carlo.start_server()
+    # Modules the app only imports on first use are imported here, once,
+    # and inherited by the workers instead of imported by a request
+    import jobs
+    jobs.import_deferred_modules()
+
+def on_exit(server):
+    import monte_carlo
+    monte_carlo.stop_server()
@@ -0,0 +1,62 @@
+import os
+import sys
+import subprocess
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Importing the app must stay within this many seconds
+budget_seconds = float(os.getenv('IMPORT_BUDGET_SECONDS', 2.0))
+# Loaded on first use only, importing the app must not load these
+deferred_modules = ['sqlalchemy', 'psycopg2', 'yfinance', 'plotly.express']
+
+check_script = f"""
+import sys
+import application
+import db
+print('engine', db.engine is not None)
+for module in {deferred_modules!r}:
+    print('module', module, module in sys.modules)
+"""
+
+def measure(module:str='application', top:int=15) -> dict:
+    """
+    Imports the module in a fresh interpreter with -X importtime and returns
+    the total import time in seconds and the top modules by cumulative time,
+    along with whether the database engine or any deferred module was loaded.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', check_script.replace('application', module, 1)],
+                            cwd=here, capture_output=True, text=True, check=True)
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        timings.append((int(cumulative) / 1e6, depth, name.strip()))
+
+    eager = {}
+    engine_created = False
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if fields[0] == 'engine':
+            engine_created = fields[1] == 'True'
+        elif fields[0] == 'module':
+            eager[fields[1]] = fields[2] == 'True'
+    return {
+        'total_seconds': sum(seconds for seconds, depth, _ in timings if depth == 0),
+        'top': sorted([(seconds, name) for seconds, depth, name in timings if depth <= 1], reverse=True)[:top],
+        'engine_created': engine_created,
+        'eager_modules': [name for name, loaded in eager.items() if loaded],
+    }
+
+if __name__ == '__main__':
+    report = measure()
+    print(f"import application: {report['total_seconds']:.2f} s (budget {budget_seconds:.2f} s)")
+    for seconds, name in report['top']:
+        print(f'  {seconds:6.3f} s  {name}')
+    print(f"database engine created at import: {report['engine_created']}")
+    print(f"deferred modules loaded at import: {', '.join(report['eager_modules']) or 'none'}")
+    within_budget = report['total_seconds'] <= budget_seconds
+    sys.exit(0 if within_budget and not report['engine_created'] and not report['eager_modules'] else 1)
@@ -0,0 +1,158 @@
+import os
+import time
+import signal
+import importlib
+import functools
+import multiprocessing
+import disk_cache
+import metrics
+from dash import DiskcacheManager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Background callbacks run in their own process, with their progress and
+# results passed back to the web workers through a disk cache
+jobs_dir = os.getenv('BACKGROUND_JOBS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.background_jobs'))
+# Jobs running or starting at the same time, shared by all gunicorn workers
+max_jobs = int(os.getenv('BACKGROUND_JOB_LIMIT', 4))
+# A job still running after this many seconds is stopped and its slot freed
+job_timeout_seconds = float(os.getenv('BACKGROUND_JOB_TIMEOUT_SECONDS', 120))
+
+# Modules the app imports on first use to keep its own import fast, see
+# import_budget.py, and that pandas imports on the first Parquet read. The
+# gunicorn master imports them before forking the workers, so only the
+# startup is deferred, not the import.
+deferred_modules = ['sqlalchemy', 'psycopg2', 'yfinance', 'pyarrow.parquet', 'pyarrow.dataset']
+
+# Jobs are forked from a server process that imported these modules before
+# starting any thread, never from a web worker, where another thread may
+# hold an import lock or any other lock at the time of the fork
+_context = multiprocessing.get_context('forkserver')
+preload_modules = ['application', *deferred_modules]
+
+def import_deferred_modules():
+    for module in deferred_modules:
+        importlib.import_module(module)
+
+def start_server():
+    """
+    Starts the process jobs are forked from, otherwise started with the
+    first job. Called by every gunicorn worker before it serves requests.
+    """
+    _context.set_forkserver_preload(preload_modules)
+    multiprocessing.forkserver.ensure_running()
+
+class JobTimeout(BaseException):
+    # Not an Exception, so that Dash does not report it as a callback error
+    pass
+
+def _raise_timeout(signum, frame):
+    raise JobTimeout()
+
+def _run_job(long_key:str, result_key:str, progress_key:str, args, context:dict):
+    # The server has imported the app, which registers the callbacks
+    importlib.import_module('application')
+    job_fn = background_manager.func_registry[long_key]
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.alarm(int(job_timeout_seconds))
+    try:
+        _flushing_metrics(job_fn)(result_key, progress_key, args, context)
+    except JobTimeout:
+        metrics.count('background_job_timeout')
+        metrics.flush()
+        background_manager.handle.set(result_key, background_manager._message_result(context, background_manager.timeout_outputs))
+
+def _flushing_metrics(job_fn):
+    # A job process exits as soon as the callback returns, before the next
+    # periodic flush, so its metrics are written on the way out
+    @functools.wraps(job_fn)
+    def run_job(*args):
+        try:
+            return job_fn(*args)
+        finally:
+            metrics.flush()
+    return run_job
+
+class BoundedDiskcacheManager(DiskcacheManager):
+    """
+    DiskcacheManager that starts jobs from the job server and refuses to
+    start more than max_jobs jobs. A refused callback returns busy_outputs, a
+    component id to value mapping, for the outputs it has and no update for
+    the rest, without starting a process. A job running for longer than
+    job_timeout_seconds returns timeout_outputs instead of its result.
+    """
+    jobs_key = 'background-jobs'
+    # A slot reserved for a job that has not reported its pid yet is
+    # released after this many seconds, and a job that did not stop itself
+    # on timeout is killed this many seconds later
+    reservation_seconds = 10
+
+    def __init__(self, cache, max_jobs:int, job_timeout_seconds:float, busy_outputs:dict=None, timeout_outputs:dict=None, **kwargs):
+        super().__init__(cache, **kwargs)
+        self.max_jobs = max_jobs
+        self.job_timeout_seconds = job_timeout_seconds
+        self.busy_outputs = busy_outputs or {}
+        self.timeout_outputs = timeout_outputs or {}
+
+    def _reserve_slot(self) -> str:
+        reservation = f'{os.getpid()}-{time.time()}'
+        with self.handle.transact():
+            jobs = self.handle.get(self.jobs_key, {})
+            ages = {slot: time.time() - float(slot.split('-')[1]) for slot in jobs}
+            overdue = [pid for slot, pid in jobs.items() if pid is not None and ages[slot] > self.job_timeout_seconds + self.reservation_seconds]
+            jobs = {
+                slot: pid for slot, pid in jobs.items()
+                if (pid is None and ages[slot] < self.reservation_seconds)
+                or (pid is not None and pid not in overdue and self.job_running(pid))
+            }
+            if len(jobs) >= self.max_jobs:
+                reservation = None
+            else:
+                jobs[reservation] = None
+            self.handle.set(self.jobs_key, jobs)
+        for pid in overdue:
+            self.terminate_job(pid)
+        return reservation
+
+    def _set_slot(self, reservation:str, pid:int):
+        with self.handle.transact():
+            jobs = self.handle.get(self.jobs_key, {})
+            jobs[reservation] = pid
+            self.handle.set(self.jobs_key, jobs)
+
+    def _message_result(self, context, messages:dict) -> list:
+        outputs = []
+        for output in context['outputs_list']:
+            if output['id'] in messages:
+                outputs.append(messages[output['id']])
+            else:
+                outputs.append({'_dash_no_update': '_dash_no_update'})
+        return outputs
+
+    def call_job_fn(self, key, job_fn, args, context):
+        reservation = self._reserve_slot()
+        if reservation is None:
+            # Job 0 is never running, so the result is read straight away
+            self.handle.set(key, self._message_result(context, self.busy_outputs))
+            return 0
+        long_key = next(long_key for long_key, registered in self.func_registry.items() if registered is job_fn)
+        process = _context.Process(target=_run_job, args=(long_key, key, self._make_progress_key(key), args, dict(context)))
+        _context.set_forkserver_preload(preload_modules)
+        process.start()
+        self._set_slot(reservation, process.pid)
+        return process.pid
+
+background_manager = BoundedDiskcacheManager(
+    disk_cache.Cache(jobs_dir),
+    max_jobs=max_jobs,
+    job_timeout_seconds=job_timeout_seconds,
+    busy_outputs={
+        'not_found_tickers': 'The server is busy, please try plotting again in a moment',
+        'already_exists_error': 'The server is busy, please try again in a moment',
+    },
+    timeout_outputs={
+        'not_found_tickers': 'Plotting took too long and was stopped, please try a smaller portfolio',
+        'already_exists_error': 'Saving took too long and was stopped, please try again',
+    }
+)
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import shutil
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+
+# Reuses the scratch stores and the SQLite stand-in of the benchmarks
+import benchmark
+import db
+import fetcher
+import jobs
+import session_store
+
+here = os.path.dirname(os.path.abspath(__file__))
+results_path = os.getenv('LOADTEST_RESULTS', os.path.join(here, 'loadtest_results.json'))
+sqlite_path = os.path.join(benchmark.scratch_dir, 'loadtest.sqlite')
+
+# Tickers the local provider knows, anything else is not found
+universe = [f'LT{i:03d}' for i in range(40)]
+# Seconds between polls of a background callback, as the browser does
+poll_seconds = 0.1
+# A background callback that has not answered by then counts as an error
+callback_timeout_seconds = 120
+
+def local_download(ticker:str, start=None) -> pd.Series:
+    """
+    Deterministic stand-in for fetcher.download_ticker, returning the same
+    synthetic adjusted closes for a ticker on every call.
+    """
+    if ticker not in universe + ['ACWI', '^IRX']:
+        return None
+    dates = pd.bdate_range(end=pd.Timestamp.now().normalize(), periods=5 * 261)
+    if ticker == '^IRX':
+        prices = pd.Series(5.0, index=dates)
+    else:
+        rng = np.random.default_rng(zlib.crc32(ticker.encode()))
+        prices = pd.Series(100 * np.exp(np.cumsum(rng.normal(0.0003, 0.01, len(dates)))), index=dates)
+    if start is not None:
+        prices = prices[prices.index >= pd.Timestamp(start)]
+    return prices.rename(ticker)
+
+def sqlite_write_portfolios(frames, replace:bool=False) -> set:
+    """
+    Stand-in for db.write_portfolios on SQLite, which has no COPY.
+    """
+    skipped_portfolios = set()
+    session_ids = set()
+    with db.get_engine().begin() as connection:
+        for frame in frames:
+            for (session_id, portfolio_id), portfolio in frame.groupby(['session_id', 'portfolio_id']):
+                session_ids.add(session_id)
+                exists = connection.execute(db.sql("""
+                    select 1 from portfolio_builder.portfolios where session_id = :session_id and portfolio_id = :portfolio_id
+                    union select 1 from portfolio_builder.example_portfolios where portfolio_id = :portfolio_id
+                """), {'session_id': session_id, 'portfolio_id': portfolio_id}).first()
+                if exists and not replace:
+                    skipped_portfolios.add((session_id, portfolio_id))
+                    continue
+                connection.execute(db.sql(db.remove_portfolio_query), {'session_id': session_id, 'portfolio_id': portfolio_id})
+                portfolio[db.portfolio_columns].to_sql('portfolios', connection, schema='portfolio_builder', if_exists='append', index=False)
+    for session_id in session_ids:
+        session_store.bump_version(session_id)
+    return skipped_portfolios
+
+def install_stand_ins(database_url:str=None):
+    """
+    Replaces the price provider with local_download, and the database with
+    the Postgres at database_url or the SQLite stand-in in the scratch
+    directory.
+    """
+    from sqlalchemy import create_engine
+
+    fetcher.download_ticker = local_download
+    if database_url:
+        db.engine = create_engine(database_url)
+    else:
+        db.engine = benchmark.sqlite_engine(path=sqlite_path)
+        db.write_portfolios = sqlite_write_portfolios
+
+def start_local_server(database_url:str=None) -> str:
+    """
+    Serves the app from a threaded server in this process, with the stand-ins
+    of install_stand_ins. Background callbacks run in processes forked from
+    the job server, which preloads this module to install the same stand-ins
+    and finds the scratch directory and the database in the environment.
+    Returns the base URL.
+    """
+    from werkzeug.serving import make_server
+
+    if database_url:
+        import migrate
+        install_stand_ins(database_url)
+        migrate.migrate()
+    else:
+        benchmark.create_database(n_rows=0, path=sqlite_path)
+        install_stand_ins()
+    os.environ['BENCHMARK_DIR'] = benchmark.scratch_dir
+    os.environ['LOADTEST_DATABASE_URL'] = database_url or ''
+    jobs.preload_modules.append('loadtest')
+
+    import application
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, application.application, threaded=True)
+    threading.Thread(target=server.serve_forever, name='loadtest-server', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+class Client:
+    """
+    Sends callback requests the way the Dash renderer does, using the
+    callback definitions served by the app itself.
+    """
+    def __init__(self, base_url:str, session_id:str):
+        self.base_url = base_url
+        self.session_id = session_id
+        self.http = requests.Session()
+
+    def call(self, callbacks:dict, output:str, values:dict, changed:str) -> (str, dict):
+        """
+        Triggers the callback of output with the component values, given as
+        {'id.property': value}, and polls background callbacks until they
+        answer. Returns 'ok', 'busy' or 'error' and the response.
+        """
+        spec = callbacks[output]
+        body = {
+            'output': output,
+            'outputs': _parse_outputs(output),
+            'inputs': [{**dependency, 'value': values.get(f"{dependency['id']}.{dependency['property']}")} for dependency in spec['inputs']],
+            'state': [{**dependency, 'value': values.get(f"{dependency['id']}.{dependency['property']}")} for dependency in spec['state']],
+            'changedPropIds': [changed],
+        }
+        url = f'{self.base_url}/_dash-update-component'
+        response = self.http.post(url, json=body, timeout=callback_timeout_seconds)
+        if response.status_code == 200 and 'cacheKey' in response.json():
+            # A background callback answers with its job, polled for the result
+            job = {'cacheKey': response.json()['cacheKey'], 'job': response.json()['job']}
+            deadline = time.time() + callback_timeout_seconds
+            while True:
+                time.sleep(poll_seconds)
+                response = self.http.post(url, params=job, json=body, timeout=callback_timeout_seconds)
+                if response.status_code != 200 or 'response' in response.json():
+                    break
+                if time.time() > deadline:
+                    return 'error', None
+        if response.status_code == 204:
+            return 'ok', None
+        if response.status_code != 200 or 'response' not in response.json():
+            return 'error', None
+        result = response.json()['response']
+        if 'server is busy' in json.dumps(result):
+            return 'busy', result
+        return 'ok', result
+
+def _parse_outputs(output:str):
+    # Multiple outputs are joined as ..id.property...id.property..
+    if not output.startswith('..'):
+        component_id, component_property = output.rsplit('.', 1)
+        return {'id': component_id, 'property': component_property}
+    return [dict(zip(['id', 'property'], part.rsplit('.', 1))) for part in output[2:-2].split('...')]
+
+def find_output(callbacks:dict, component:str) -> str:
+    return next(output for output in callbacks if f'{component}.' in output)
+
+def run_session(base_url:str, callbacks:dict, n_assets:int, monte_carlo_share:float, seed:int) -> list:
+    """
+    Follows the add asset, save and plot flow of one session and returns
+    (callback, seconds, status) of every callback it triggered.
+    """
+    rng = np.random.default_rng(seed)
+    client = Client(base_url, str(uuid.uuid4()))
+    timings = []
+
+    def timed(name:str, output:str, values:dict, changed:str):
+        start = time.perf_counter()
+        try:
+            status, _ = client.call(callbacks, output, {'session-id.data': client.session_id, **values}, changed)
+        except requests.RequestException:
+            status = 'error'
+        timings.append((name, time.perf_counter() - start, status))
+
+    for i, ticker in enumerate(rng.choice(universe, n_assets, replace=False)):
+        timed('update_asset_list', find_output(callbacks, 'components'),
+              {'addAssetButton.n_clicks': i + 1, 'ticker.value': ticker, 'purchaseAmount.value': int(rng.integers(100, 1000))}, 'addAssetButton.n_clicks')
+    timed('save_portfolio', find_output(callbacks, 'already_exists_error'),
+          {'save_portfolio.n_clicks': 1, 'pf_name.value': 'loadtest'}, 'save_portfolio.n_clicks')
+    method = 'monte_carlo' if rng.random() < monte_carlo_share else 'lognormal'
+    timed('updatePlot', find_output(callbacks, 'projection-params'),
+          {'createPortfolio.n_clicks': 1, 'years.value': '10', 'confidence.value': '90%', 'portfolio_id.value': 'Current', 'projection_method.value': method}, 'createPortfolio.n_clicks')
+    return timings
+
+def run_level(base_url:str, callbacks:dict, concurrency:int, sessions:int, n_assets:int, monte_carlo_share:float) -> list:
+    """
+    Runs sessions sessions with concurrency of them at a time and returns
+    the throughput, latency percentiles and error rate of every callback.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_session, base_url, callbacks, n_assets, monte_carlo_share, seed) for seed in range(sessions)]
+        timings = [timing for future in futures for timing in future.result()]
+    elapsed = time.perf_counter() - start
+
+    frame = pd.DataFrame(timings, columns=['callback', 'seconds', 'status'])
+    results = []
+    for callback, calls in frame.groupby('callback'):
+        latencies = calls['seconds'].values
+        results.append({
+            'concurrency': concurrency,
+            'callback': callback,
+            'calls': len(calls),
+            'throughput_per_second': len(calls) / elapsed,
+            'p50_seconds': float(np.percentile(latencies, 50)),
+            'p95_seconds': float(np.percentile(latencies, 95)),
+            'p99_seconds': float(np.percentile(latencies, 99)),
+            'error_rate': float((calls['status'] == 'error').mean()),
+            'busy_rate': float((calls['status'] == 'busy').mean()),
+        })
+    return results
+
+# Imported by the job server of a locally started app, see start_local_server
+if __name__ != '__main__' and os.getenv('LOADTEST_DATABASE_URL') is not None:
+    install_stand_ins(os.getenv('LOADTEST_DATABASE_URL'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays concurrent pf_builder sessions against the Dash callback endpoints')
+    parser.add_argument('--url', help='base URL of a running app, by default one is started locally with stubbed prices')
+    parser.add_argument('--database-url', help='local Postgres for the locally started app, by default a SQLite stand-in')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma separated numbers of concurrent sessions')
+    parser.add_argument('--sessions', type=int, default=2, help='sessions run per concurrent session slot')
+    parser.add_argument('--assets', type=int, default=3, help='assets added by every session')
+    parser.add_argument('--monte-carlo-share', type=float, default=0.0, help='share of plots simulated with Monte Carlo')
+    arguments = parser.parse_args()
+
+    try:
+        base_url = arguments.url or start_local_server(arguments.database_url)
+        callbacks = {callback['output']: callback for callback in requests.get(f'{base_url}/_dash-dependencies', timeout=30).json()}
+        results = []
+        print(f"{'concurrency':>11s} {'callback':20s} {'calls':>6s} {'per s':>8s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'errors':>7s} {'busy':>6s}")
+        for concurrency in [int(level) for level in arguments.concurrency.split(',')]:
+            for result in run_level(base_url, callbacks, concurrency, concurrency * arguments.sessions, arguments.assets, arguments.monte_carlo_share):
+                results.append(result)
+                print(f"{result['concurrency']:>11d} {result['callback']:20s} {result['calls']:>6d} {result['throughput_per_second']:>8.2f} "
+                      f"{result['p50_seconds']*1000:>9.1f} {result['p95_seconds']*1000:>9.1f} {result['p99_seconds']*1000:>9.1f} "
+                      f"{result['error_rate']:>7.1%} {result['busy_rate']:>6.1%}")
+        with open(results_path, 'w') as file:
+            json.dump({'url': arguments.url or 'local', 'results': results}, file, indent=2)
+    finally:
+        if not benchmark.keep_scratch_dir:
+            shutil.rmtree(benchmark.scratch_dir, ignore_errors=True)
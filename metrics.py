@@ -0,0 +1,233 @@
+import os
+import hmac
+import time
+import logging
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+import diskcache
+import disk_cache
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Timings and counters shared by all gunicorn workers and background jobs,
+# which run in their own processes, so /metrics sees all of them
+metrics_dir = os.getenv('METRICS_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.metrics'))
+# Each process adds up its metrics in memory and writes them to the shared
+# store every flush_seconds, in one transaction
+flush_seconds = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+# Upper bounds in seconds of the span duration histogram buckets
+buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# off, header to profile requests sent with the profile_header, or all
+profile_requests = os.getenv('PROFILE_REQUESTS', 'off')
+profile_header = 'X-Profile'
+profile_dir = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.profiles'))
+# /metrics and profiling by header are only served to requests bearing this
+# token, or without one to requests from this host that did not pass a proxy
+metrics_token = os.getenv('METRICS_TOKEN')
+
+store = disk_cache.Cache(metrics_dir)
+
+_lock = threading.Lock()
+_pending = Counter()
+_flusher_pid = None
+
+def _reset_after_fork():
+    # The metrics pending in the parent are written by the parent
+    global _lock, _pending, _flusher_pid
+    _lock = threading.Lock()
+    _pending = Counter()
+    _flusher_pid = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def flush():
+    """
+    Writes the metrics added up in this process to the shared store. If the
+    store cannot be written they are kept for the next flush.
+    """
+    with _lock:
+        pending = _pending.copy()
+        _pending.clear()
+    if not pending:
+        return
+    try:
+        with store.transact():
+            for key, value in pending.items():
+                store.incr(key, value)
+    except diskcache.Timeout:
+        with _lock:
+            _pending.update(pending)
+
+def _flush_loop():
+    while True:
+        time.sleep(flush_seconds)
+        try:
+            flush()
+        except Exception:
+            logger.exception('Writing metrics failed')
+
+def _start_flusher():
+    """
+    Starts the background flusher once per process. Checked against the pid
+    so that forked gunicorn workers start their own thread.
+    """
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True).start()
+
+def _add(values:dict):
+    with _lock:
+        _pending.update(values)
+    _start_flusher()
+
+def count(event:str, value:int=1):
+    """
+    Adds value to the counter of the event, e.g. count('result_cache_hit').
+    """
+    _add({('event', event): value})
+
+def observe(stage:str, seconds:float):
+    bucket = next((i for i, upper in enumerate(buckets) if seconds <= upper), len(buckets))
+    _add({('span_count', stage): 1, ('span_microseconds', stage): int(seconds * 1e6), ('span_bucket', stage, bucket): 1})
+
+@contextmanager
+def span(stage:str):
+    """
+    Times the block into the duration histogram of the stage.
+
+    example: with metrics.span('sql'): ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def timed(stage:str):
+    """
+    Decorator timing every call of the function as the stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def callback(stage:str):
+    """
+    Decorator timing every call of a Dash callback as the stage. Also marks
+    when the callback returned, so that the serialization of its outputs is
+    timed until the response is sent, see instrument.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            import flask
+            with span(stage):
+                outputs = function(*args, **kwargs)
+            if flask.has_request_context():
+                flask.g.callback_returned = time.perf_counter()
+            return outputs
+        return wrapper
+    return decorator
+
+def render() -> str:
+    """
+    Returns the metrics in the Prometheus text exposition format, with those
+    of this process written first.
+    """
+    flush()
+    events = {}
+    span_counts = {}
+    span_microseconds = {}
+    span_buckets = {}
+    for key in store.iterkeys():
+        value = store.get(key, 0)
+        if key[0] == 'event':
+            events[key[1]] = value
+        elif key[0] == 'span_count':
+            span_counts[key[1]] = value
+        elif key[0] == 'span_microseconds':
+            span_microseconds[key[1]] = value
+        elif key[0] == 'span_bucket':
+            span_buckets[(key[1], key[2])] = value
+
+    lines = [
+        '# HELP portfolio_builder_events_total Cache hits and misses, not found tickers and other events.',
+        '# TYPE portfolio_builder_events_total counter',
+    ]
+    lines += [f'portfolio_builder_events_total{{event="{event}"}} {value}' for event, value in sorted(events.items())]
+    lines += [
+        '# HELP portfolio_builder_span_seconds Time spent in each stage.',
+        '# TYPE portfolio_builder_span_seconds histogram',
+    ]
+    for stage in sorted(span_counts):
+        cumulative = 0
+        for i, upper in enumerate(buckets + (float('inf'),)):
+            cumulative += span_buckets.get((stage, i), 0)
+            le = '+Inf' if upper == float('inf') else repr(upper)
+            lines.append(f'portfolio_builder_span_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+        lines.append(f'portfolio_builder_span_seconds_sum{{stage="{stage}"}} {span_microseconds.get(stage, 0) / 1e6}')
+        lines.append(f'portfolio_builder_span_seconds_count{{stage="{stage}"}} {span_counts[stage]}')
+    return '\n'.join(lines) + '\n'
+
+def _internal(request) -> bool:
+    if metrics_token is not None:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {metrics_token}')
+    return request.remote_addr in ('127.0.0.1', '::1') and 'X-Forwarded-For' not in request.headers
+
+def _profiling(request) -> bool:
+    return profile_requests == 'all' or (profile_requests == 'header' and request.headers.get(profile_header) is not None and _internal(request))
+
+def instrument(app):
+    """
+    Adds the /metrics route and request timing to the Flask server of the Dash
+    app, times the JSON serialization of the outputs of callbacks decorated
+    with callback, and profiles the requests selected by PROFILE_REQUESTS
+    into profile_dir.
+    """
+    import flask
+
+    server = app.server
+
+    @server.route('/metrics')
+    def metrics_route():
+        if not _internal(flask.request):
+            flask.abort(403)
+        return flask.Response(render(), mimetype='text/plain; version=0.0.4')
+
+    @server.before_request
+    def start_request():
+        flask.g.request_start = time.perf_counter()
+        if _profiling(flask.request):
+            import cProfile
+            flask.g.profiler = cProfile.Profile()
+            flask.g.profiler.enable()
+
+    @server.after_request
+    def finish_request(response):
+        profiler = flask.g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            path = os.path.join(profile_dir, f"{time.time():.6f}-{flask.request.path.strip('/').replace('/', '_') or 'index'}.prof")
+            profiler.dump_stats(path)
+            response.headers['X-Profile-File'] = os.path.basename(path)
+        if 'request_start' in flask.g and flask.request.path != '/metrics':
+            observe('request', time.perf_counter() - flask.g.request_start)
+        # Dash serializes the outputs between the callback and this hook
+        if 'callback_returned' in flask.g:
+            observe('serialization', time.perf_counter() - flask.g.callback_returned)
+        return response
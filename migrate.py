@@ -0,0 +1,83 @@
+import os
+import re
+import sys
+from sqlalchemy import text
+
+import db
+
+# Numbered SQL files, applied in order and each at most once
+migrations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+create_migrations_table_statement = text("""
+    create table if not exists public.schema_migrations (
+        version integer primary key,
+        name text not null,
+        applied_at timestamptz not null default now()
+    )
+""")
+
+applied_migrations_query = text("select version from public.schema_migrations")
+
+record_migration_statement = text("insert into public.schema_migrations (version, name) values (:version, :name)")
+
+# Held while migrating, so workers or releases starting together take turns
+migration_lock_statement = text("select pg_advisory_lock(hashtext('schema_migrations'))")
+migration_unlock_statement = text("select pg_advisory_unlock(hashtext('schema_migrations'))")
+
+def get_migrations() -> list:
+    """
+    Returns (version, name, path) of every migration file, ordered by version.
+    """
+    migrations = []
+    for file_name in os.listdir(migrations_dir):
+        match = re.fullmatch(r'(\d+)_(\w+)\.sql', file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(migrations_dir, file_name)))
+    return sorted(migrations)
+
+def get_applied_versions(connection) -> set:
+    connection.execute(create_migrations_table_statement)
+    return {row[0] for row in connection.execute(applied_migrations_query)}
+
+def migrate() -> list:
+    """
+    Applies the pending migrations, each in its own transaction together with
+    its record in public.schema_migrations. Returns the names applied.
+    """
+    applied = []
+    with db.get_engine().connect() as connection:
+        connection.execute(migration_lock_statement)
+        connection.commit()
+        try:
+            applied_versions = get_applied_versions(connection)
+            connection.commit()
+            for version, name, path in get_migrations():
+                if version in applied_versions:
+                    continue
+                with open(path) as file:
+                    connection.exec_driver_sql(file.read())
+                connection.execute(record_migration_statement, {'version': version, 'name': name})
+                connection.commit()
+                applied.append(f'{version:04d}_{name}')
+        finally:
+            connection.rollback()
+            connection.execute(migration_unlock_statement)
+            connection.commit()
+    return applied
+
+def status() -> list:
+    """
+    Returns the name of every migration with whether it has been applied.
+    """
+    with db.get_engine().connect() as connection:
+        applied_versions = get_applied_versions(connection)
+        connection.commit()
+    return [(f'{version:04d}_{name}', version in applied_versions) for version, name, _ in get_migrations()]
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['status']:
+        for name, is_applied in status():
+            print(f"{'applied' if is_applied else 'pending'}  {name}")
+    else:
+        for name in migrate():
+            print(f'applied  {name}')
@@ -0,0 +1,28 @@
+-- Schemas and tables as they existed before migrations were tracked
+create schema if not exists portfolio_builder;
+create schema if not exists cars_demo;
+
+create table if not exists portfolio_builder.example_portfolios (
+    portfolio_id text,
+    ticker text,
+    historical_return double precision,
+    historical_volatility double precision,
+    beta double precision,
+    expected_return double precision,
+    risk_free_rate double precision,
+    weight double precision,
+    amount double precision
+);
+
+create table if not exists portfolio_builder.portfolios (
+    session_id text,
+    portfolio_id text,
+    ticker text,
+    historical_return double precision,
+    historical_volatility double precision,
+    beta double precision,
+    expected_return double precision,
+    risk_free_rate double precision,
+    weight double precision,
+    amount double precision
+);
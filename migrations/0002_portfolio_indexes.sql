@@ -0,0 +1,15 @@
+-- Saved portfolios are always looked up by session, and by name within it
+create index if not exists portfolios_session_portfolio_idx
+    on portfolio_builder.portfolios (session_id, portfolio_id);
+
+create index if not exists example_portfolios_portfolio_idx
+    on portfolio_builder.example_portfolios (portfolio_id);
+
+-- The cars table is loaded by the demo page, not created by the app
+do $$
+begin
+    if to_regclass('cars_demo.cars') is not null then
+        create index if not exists cars_year_idx on cars_demo.cars (year);
+    end if;
+end
+$$;
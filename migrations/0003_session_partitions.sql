@@ -0,0 +1,46 @@
+-- Sessions that saved portfolios, with when they were created and last used
+create table if not exists portfolio_builder.sessions (
+    session_id text primary key,
+    created_at timestamptz not null default now(),
+    last_used_at timestamptz not null default now()
+);
+
+create index if not exists sessions_last_used_idx
+    on portfolio_builder.sessions (last_used_at);
+
+-- Saved portfolios are partitioned by the day they were saved, so expired
+-- days are dropped whole by retention.py. Rows saved on a day without a
+-- partition land in the default partition until retention.py creates it.
+alter table portfolio_builder.portfolios rename to portfolios_unpartitioned;
+alter index portfolio_builder.portfolios_session_portfolio_idx rename to portfolios_unpartitioned_session_portfolio_idx;
+
+create table portfolio_builder.portfolios (
+    session_id text,
+    portfolio_id text,
+    ticker text,
+    historical_return double precision,
+    historical_volatility double precision,
+    beta double precision,
+    expected_return double precision,
+    risk_free_rate double precision,
+    weight double precision,
+    amount double precision,
+    saved_on date not null default current_date
+) partition by range (saved_on);
+
+create index portfolios_session_portfolio_idx
+    on portfolio_builder.portfolios (session_id, portfolio_id);
+
+create table portfolio_builder.portfolios_default
+    partition of portfolio_builder.portfolios default;
+
+insert into portfolio_builder.portfolios (session_id, portfolio_id, ticker, historical_return, historical_volatility, beta, expected_return, risk_free_rate, weight, amount)
+select session_id, portfolio_id, ticker, historical_return, historical_volatility, beta, expected_return, risk_free_rate, weight, amount
+from portfolio_builder.portfolios_unpartitioned;
+
+insert into portfolio_builder.sessions (session_id)
+select distinct session_id from portfolio_builder.portfolios_unpartitioned
+where session_id is not null
+on conflict (session_id) do nothing;
+
+drop table portfolio_builder.portfolios_unpartitioned;
@@ -1,185 +1,211 @@
-from dash import html, dcc, callback, callback_context, Output, Input, State
+from dash import html, dcc, clientside_callback, ClientsideFunction, Output, Input
 import dash_bootstrap_components as dbc
 import dash
-from dash import callback
+import os
+import time
+import logging
+import threading
 import pandas as pd
 import ETL as etl
 
+logger = logging.getLogger(__name__)
+
 
 dash.register_page(__name__)
 
-data = etl.get_cars_table()
-df = pd.DataFrame(data)
-df.columns = df.columns.str.replace('_', ' ').str.capitalize()
-
-layout = dbc.Container(html.Div([
-    html.H1("Car Data by Power and Type",style={'textAlign':'center'}),
-
-    html.Div(["Power type: ",
-        dcc.Dropdown(
-            id='car-type-dropdown',
-            options=[
-                {'label': 'All Cars', 'value': 'All'},
-                {'label': 'Hybrid', 'value': 'Hybrid'},
-                {'label': 'Electric', 'value': 'Electric'}],
-            value='All')
-            ]
-    ),
-
-    dcc.Graph(
-        id='cars-line-chart',
-    ),
-
-    dcc.Slider(
-        id='year-slider',
-        min=df['Year'].min(),
-        max=df['Year'].max(),
-        marks={str(year): str(year) for year in df['Year'].unique()},
-        value=df['Year'].max(),
-        step=None
-    ),
-
-    dbc.Row(
-        [
-            dbc.Col(
-                [
-                    html.Div(
-                        dcc.Graph(
-                            id='electric-pie-chart',
-                        ),
-                    )
-                ],
-                width=4
-            ),
-            dbc.Col(
-                [
-                    html.Div(
-                        dcc.Graph(
-                            id='hybrid-pie-chart',
-                        ),
-                    )
-                ],
-                width=4
-            ),
-            dbc.Col(
-                [
-                    html.Div(
-                        dcc.Graph(
-                            id='all-pie-chart',
-                        ),
-                    )
-                ],
-                width=4
-            ),
-        ]
-    )
-],style={'margin-left': '5%','margin-right': '5%',}),fluid=True
-)
+# The cars table is read on the first page load and again once it is older
+# than refresh_seconds, with the figures of every year built once per read
+refresh_seconds = float(os.getenv('CARS_REFRESH_SECONDS', 3600))
 
+_lock = threading.Lock()
+_figures = None
+_loaded_at = 0.0
 
-@callback(
-    Output('electric-pie-chart', 'figure'),
-    Output('hybrid-pie-chart', 'figure'),
-    Output('all-pie-chart', 'figure'),
-    [Input('year-slider', 'value')]
-)
-def update_pie_chart(selected_year):
-    filtered_df = df[df['Year'] == selected_year]
-
-    electric_cars = {
-        'data': [
-            {
-                'labels': df.columns[[1,3,5,7]],
-                'values': filtered_df.iloc[0,[1,3,5,7]],
-                'type': 'pie',
-                'name': 'Electric Cars'
+line_chart_columns = {
+    'Electric': [
+        'Battery electric passenger cars',
+        'Battery electric vans',
+        'Battery electric trucks',
+        'Battery electric buses',
+    ],
+    'Hybrid': [
+        'Plug-in hybrid passenger cars',
+        'Plug-in hybrid vans',
+        'Plug-in hybrid trucks',
+        'Plug-in hybrid buses',
+    ],
+}
+
+def build_figures(df:pd.DataFrame) -> dict:
+    """
+    Builds the three pie charts of every year and the line chart of every car
+    type, ready to be sent to the browser, where the slider and the dropdown
+    pick from them.
+    """
+    pie_charts = {}
+    # The year is read from its own column, iterrows upcasts a row with any
+    # float column to float and the year would be keyed as '2015.0'
+    for selected_year, (_, row) in zip(df['Year'].astype(int), df.iterrows()):
+        electric_cars = {
+            'data': [
+                {
+                    'labels': df.columns[[1,3,5,7]].tolist(),
+                    'values': row.iloc[[1,3,5,7]].tolist(),
+                    'type': 'pie',
+                    'name': 'Electric Cars'
+                }
+            ],
+            'layout': {
+                'title': f'Battery Electric Cars Distribution for {selected_year}'
             }
-        ],
-        'layout': {
-            'title': f'Battery Electric Cars Distribution for {selected_year}'
         }
-    }
-
-    hybrid_cars = {
-        'data': [
-            {
-                'labels': df.columns[[2,4,6,8]],
-                'values': filtered_df.iloc[0, [2,4,6,8]],
-                'type': 'pie',
-                'name': 'Hybrid Cars'
+        hybrid_cars = {
+            'data': [
+                {
+                    'labels': df.columns[[2,4,6,8]].tolist(),
+                    'values': row.iloc[[2,4,6,8]].tolist(),
+                    'type': 'pie',
+                    'name': 'Hybrid Cars'
+                }
+            ],
+            'layout': {
+                'title': f'Plug-in Hybrid Cars Distribution for {selected_year}'
             }
-        ],
-        'layout': {
-            'title': f'Plug-in Hybrid Cars Distribution for {selected_year}'
         }
-    }
-
-    all_cars = {
-        'data': [
-            {
-                'labels': df.columns[9:13],
-                'values': filtered_df.iloc[0, 9:13],
-                'type': 'pie',
-                'name': 'All Cars'
+        all_cars = {
+            'data': [
+                {
+                    'labels': df.columns[9:13].tolist(),
+                    'values': row.iloc[9:13].tolist(),
+                    'type': 'pie',
+                    'name': 'All Cars'
+                }
+            ],
+            'layout': {
+                'title': f'Cars Distribution for {selected_year}'
             }
-        ],
-        'layout': {
-            'title': f'Cars Distribution for {selected_year}'
         }
-    }
-    
-    return electric_cars, hybrid_cars, all_cars
+        # The first row of a year is shown, as when filtering the table
+        pie_charts.setdefault(str(selected_year), [electric_cars, hybrid_cars, all_cars])
 
-@callback(
-    Output('cars-line-chart', 'figure'),
-    [Input('car-type-dropdown', 'value')]
-)
-def update_line_chart(selected_type):
-    
-    if selected_type == 'Electric':
-        columns =[
-            'Battery electric passenger cars',
-            'Battery electric vans',
-            'Battery electric trucks',
-            'Battery electric buses',
-        ]
-        line_chart_data = [
-            {
-                'x': df['Year'],
-                'y': df[column],
-                'type': 'line',
-                'name': column
-            } for column in columns
-        ]
-    elif selected_type == 'Hybrid':
-        columns =[
-            'Plug-in hybrid passenger cars',
-            'Plug-in hybrid vans',
-            'Plug-in hybrid trucks',
-            'Plug-in hybrid buses',
-        ]
-        line_chart_data = [
+    line_charts = {}
+    for selected_type, columns in {**line_chart_columns, 'All': df.columns[9:14].tolist()}.items():
+        line_charts[selected_type] = {
+            'data': [
                 {
-                    'x': df['Year'],
-                    'y': df[column],
+                    'x': df['Year'].tolist(),
+                    'y': df[column].tolist(),
                     'type': 'line',
                     'name': column
                 } for column in columns
+            ],
+            'layout': {
+                'title': 'Car Type Count Over the Years'
+            }
+        }
+    return {'years': df['Year'].unique().tolist(), 'pie_charts': pie_charts, 'line_charts': line_charts}
+
+def get_figures() -> dict:
+    """
+    Returns the figures of the cars table, reading it again once they are
+    older than refresh_seconds. If the read fails, the previous figures are
+    kept, or None is returned if there are none yet.
+    """
+    global _figures, _loaded_at
+    if _figures is None or time.time() - _loaded_at > refresh_seconds:
+        try:
+            df = pd.DataFrame(etl.get_cars_table())
+            df.columns = df.columns.str.replace('_', ' ').str.capitalize()
+            figures = build_figures(df)
+        except Exception as error:
+            logger.warning('Reading the cars table failed: %s', error)
+            return _figures
+        with _lock:
+            _figures, _loaded_at = figures, time.time()
+    return _figures
+
+def layout():
+    figures = get_figures()
+    if figures is None:
+        return dbc.Container(dbc.Alert('The car data is not available right now, please try again later.', color='warning'), fluid=True)
+    years = figures['years']
+    return dbc.Container(html.Div([
+        dcc.Store(data=figures, id='cars-figures'),
+        html.H1("Car Data by Power and Type",style={'textAlign':'center'}),
+
+        html.Div(["Power type: ",
+            dcc.Dropdown(
+                id='car-type-dropdown',
+                options=[
+                    {'label': 'All Cars', 'value': 'All'},
+                    {'label': 'Hybrid', 'value': 'Hybrid'},
+                    {'label': 'Electric', 'value': 'Electric'}],
+                value='All')
+                ]
+        ),
+
+        dcc.Graph(
+            id='cars-line-chart',
+        ),
+
+        dcc.Slider(
+            id='year-slider',
+            min=min(years),
+            max=max(years),
+            marks={str(year): str(year) for year in years},
+            value=max(years),
+            step=None
+        ),
+
+        dbc.Row(
+            [
+                dbc.Col(
+                    [
+                        html.Div(
+                            dcc.Graph(
+                                id='electric-pie-chart',
+                            ),
+                        )
+                    ],
+                    width=4
+                ),
+                dbc.Col(
+                    [
+                        html.Div(
+                            dcc.Graph(
+                                id='hybrid-pie-chart',
+                            ),
+                        )
+                    ],
+                    width=4
+                ),
+                dbc.Col(
+                    [
+                        html.Div(
+                            dcc.Graph(
+                                id='all-pie-chart',
+                            ),
+                        )
+                    ],
+                    width=4
+                ),
             ]
-    else:
-        line_chart_data = [
-                {
-                    'x': df['Year'],
-                    'y': df[column],
-                    'type': 'line',
-                    'name': column
-                } for column in df.columns[9:14]
-            ]
+        )
+    ],style={'margin-left': '5%','margin-right': '5%',}),fluid=True
+    )
 
-    line_chart_figure = {
-        'data': line_chart_data,
-        'layout': {
-            'title': 'Car Type Count Over the Years'
-        }
-    }
-    return line_chart_figure
\ No newline at end of file
+
+# Switching the year or the car type only picks a prebuilt figure
+clientside_callback(
+    ClientsideFunction(namespace='cars', function_name='pieCharts'),
+    Output('electric-pie-chart', 'figure'),
+    Output('hybrid-pie-chart', 'figure'),
+    Output('all-pie-chart', 'figure'),
+    [Input('year-slider', 'value'), Input('cars-figures', 'data')]
+)
+
+clientside_callback(
+    ClientsideFunction(namespace='cars', function_name='lineChart'),
+    Output('cars-line-chart', 'figure'),
+    [Input('car-type-dropdown', 'value'), Input('cars-figures', 'data')]
+)
@@ -1,13 +1,19 @@
-from dash import Dash, html, dcc, callback, callback_context, Output, Input, State
+from dash import Dash, html, dcc, callback, callback_context, clientside_callback, ClientsideFunction, Output, Input, State
 import dash
 import dash_bootstrap_components as dbc
-import plotly.express as px
+import plotly.colors
 import plotly.graph_objects as go
 import pandas as pd
+import numpy as np
 import datetime as dt
 import uuid
 
 import ETL as etl
+import jobs
+import metrics
+import result_cache
+import session_store
+import ticker_universe
 
 dash.register_page(__name__)
 
@@ -22,7 +28,7 @@ def serve_layout():
 
     dcc.Markdown('''
     #### To add items to your current portfolio:
-    1. Input valid ticker symbol and planned purchase amount
+    1. Input valid ticker symbol and planned purchase amount, matching tickers and names are suggested as you type
     2. Press add asset
     3. Use remove and clear buttons to clear mistakes
     4. Repeat until you are satisfied
@@ -33,7 +39,8 @@ def serve_layout():
     '''),
 
     dbc.Row(dbc.Col(html.Div(["Stock ticker: ",
-        dbc.Input(id="ticker",value="SPY",type= "text")]),
+        dbc.Input(id="ticker",value="SPY",type= "text", list="ticker-suggestions"),
+        html.Datalist(id="ticker-suggestions")]),
                 width=3
     )),
     dbc.Row(dbc.Col(html.Div(["Purchase Amount: ",
@@ -44,6 +51,7 @@ def serve_layout():
     dbc.Button(id='addAssetButton', n_clicks=0, children='Add Asset'),
     dbc.Button(id='deleteAssetButton', n_clicks=0, children='Delete Asset'),
     dbc.Button(id='clearButton', n_clicks=0, children='Clear Portfolio'),
+    html.Div(id='ticker_message'),
     
     html.Br(),
     html.Br(),
@@ -64,6 +72,8 @@ def serve_layout():
     dbc.Button(id='save_portfolio', n_clicks=0, children='Save Portfolio'),
     dbc.Button(id='remove_portfolio', n_clicks=0, children='Remove Portfolio'),
     dbc.Button(id='remove_all_portfolios', n_clicks=0, children='Remove All Portfolios'),
+    dbc.Button(id='cancel_save', n_clicks=0, children='Cancel', color='secondary', style={'display': 'none'}),
+    dbc.Progress(id='save_progress', value=0, style={'display': 'none'}),
     html.Div(id='remove_pf'),
     html.Div(id='remove_all_pfs'),
 
@@ -93,6 +103,15 @@ def serve_layout():
         ],
         value='90%')]), width=3
     )),
+    dbc.Row(dbc.Col(html.Div(["Projection method: ",
+                              dcc.Dropdown(
+        id='projection_method',
+        options=[
+            {'label': 'Log-normal portfolio', 'value': 'lognormal'},
+            {'label': 'Monte Carlo per asset', 'value': 'monte_carlo'}
+        ],
+        value='lognormal')]), width=3
+    )),
     dbc.Row(dbc.Col(html.Div(["Portfolio name: ",
         dcc.Dropdown(
             id='portfolio_id',
@@ -100,6 +119,8 @@ def serve_layout():
             value='example1')]), width=3
     )),
     dbc.Button(id='createPortfolio', n_clicks=0, children='Plot Portfolio'),
+    dbc.Button(id='cancel_plot', n_clicks=0, children='Cancel', color='secondary', style={'display': 'none'}),
+    dbc.Progress(id='plot_progress', value=0, style={'display': 'none'}),
     html.Div(id="not_found_tickers"),
     html.Div(id="not_found_tickers_save"),
     html.Div(id="already_exists_error"),
@@ -112,10 +133,20 @@ def serve_layout():
                 width=6)
     ]),
 
+    dbc.Row(dbc.Col(dbc.Spinner(children=[dcc.Graph(id="backtest-graph")], color="success"),
+                width=12)),
+
+    dbc.Row(dbc.Col(html.Div(["Rolling risk of: ",
+        dcc.Dropdown(id='rolling_series', options=[], value='Portfolio', clearable=False)]), width=3
+    )),
+    dbc.Row(dbc.Col(dbc.Spinner(children=[dcc.Graph(id="rolling-graph")], color="success"),
+                width=12)),
+    dcc.Store(id='rolling-stats'),
+
     dbc.Row(dbc.Col(dbc.Spinner(children=[html.Div(id="breakdown")], color="success"),
                 width=12)),
     
-    dcc.Store(id='session-data-table'),
+    dcc.Store(id='projection-params'),
 
     dcc.Markdown('''
     
@@ -125,7 +156,11 @@ def serve_layout():
 
     2. Daily data from  [yahoo finance](https://finance.yahoo.com) is used for the calculations.
 
-    3. Confidence levels follow log-normal distribution.
+    3. The backtest shows what the portfolio would have been worth over the same history, held as bought or rebalanced back to its weights at the start of every month or quarter.
+
+    4. Rolling volatility, beta and correlation against the market are measured over the last 21, 63 and 252 trading days of each date, for the portfolio and its largest holdings.
+
+    5. Confidence levels follow log-normal distribution. With the Monte Carlo method every asset is simulated separately with its own expected return, correlated with the other assets, and the confidence levels are percentiles of the simulated portfolio values.
 
     
     @Teemu Saha.
@@ -140,40 +175,116 @@ def serve_layout():
 
 layout = serve_layout
 
+# Longer projections are sent with at most this many points per line,
+# same as maxPoints in assets/projection.js
+max_projection_points = 730
+
+def decimate_days(periodLenghtinDays:int) -> np.ndarray:
+    step = max(1, int(np.ceil(periodLenghtinDays / max_projection_points)))
+    days = np.arange(1, periodLenghtinDays+1, step)
+    if days[-1] != periodLenghtinDays:
+        days = np.append(days, periodLenghtinDays)
+    return days
+
+def young_tickers_warning(tickers:list) -> str:
+    young = etl.young_tickers(tickers)
+    if not young:
+        return None
+    first_dates = ', '.join(f'{ticker} since {first_date:%Y-%m-%d}' for ticker, first_date in sorted(young.items()))
+    return f'Note > Shorter price history than the others, which shortens the history the backtest and the rolling portfolio statistics are based on: {first_dates}'
+
+@callback(
+    Output('ticker-suggestions', 'children'),
+    Input('ticker', 'value')
+)
+@metrics.callback('callback_suggest_tickers')
+def suggest_tickers(ticker):
+    return [html.Option(value=symbol, label=name) for symbol, name in ticker_universe.complete(ticker)]
+
+def backtest_figure(amounts:pd.Series) -> go.Figure:
+    # Values on top and drawdowns below, one color per rebalancing schedule
+    backtest = etl.calculate_backtest(amounts)
+    figure = go.Figure()
+    if backtest is None:
+        return figure
+    values, drawdowns, summary = backtest
+    for i, name in enumerate(values.columns):
+        color = plotly.colors.qualitative.Plotly[i % len(plotly.colors.qualitative.Plotly)]
+        row = summary.loc[name]
+        figure.add_trace(go.Scatter(
+            x=values.index, y=values[name], name=name, legendgroup=name, line={'color': color},
+            hovertemplate=f"{name}: %{{y:.0f}}<br>Annual return {row['annual_return']:.1%}, max drawdown {row['max_drawdown']:.1%}, turnover {row['annual_turnover']:.0%} a year<extra></extra>",
+        ))
+        figure.add_trace(go.Scatter(
+            x=drawdowns.index, y=drawdowns[name], name=name, legendgroup=name, showlegend=False, yaxis='y2', line={'color': color},
+            hovertemplate=f"{name} drawdown: %{{y:.1%}}<extra></extra>",
+        ))
+    figure.update_layout(
+        title='Backtest over the price history',
+        yaxis={'domain': [0.35, 1], 'title': 'Value'},
+        yaxis2={'domain': [0, 0.28], 'title': 'Drawdown', 'tickformat': '.0%'},
+    )
+    return figure
+
+# The rolling statistics of the portfolio and of at most this many of its
+# largest holdings are sent to the browser, one point every rolling_step days
+rolling_chart_assets = 20
+rolling_step = 5
+
+def rolling_chart_data(amounts:pd.Series) -> dict:
+    # Drawn by rolling.chart in assets/rolling.js for the chosen series
+    stats = etl.calculate_rolling_stats(amounts)
+    if stats is None:
+        return None
+    holdings = amounts.sort_values(ascending=False).index
+    names = ['Portfolio'] + [ticker for ticker in holdings if ticker in stats.columns.get_level_values(0)][:rolling_chart_assets]
+    # Every rolling_step days counted back from the last day
+    stats = stats.iloc[(len(stats) - 1) % rolling_step::rolling_step]
+    series = {}
+    for name in names:
+        values = stats[name].round(4)
+        series[name] = values.astype(object).where(values.notna(), None).to_dict('list')
+    return {'dates': stats.index.strftime('%Y-%m-%d').tolist(), 'series': series}
+
+# The current portfolio is kept in session_store, so the browser only sends
+# the session id and the asset to add or delete
 @callback(
     Output(component_id= "components", component_property= "children"),
-    Output(component_id= "session-data-table", component_property= "data"),
+    Output('ticker_message', 'children'),
     [Input('addAssetButton', 'n_clicks')],
     [Input('deleteAssetButton', 'n_clicks')],
     [Input('clearButton', 'n_clicks')],
-    [State('session-data-table', 'data')],
+    [State('session-id', 'data')],
     [State(component_id= "ticker",component_property= "value"),
     State(component_id= "purchaseAmount",component_property= "value")]
 )
-def update_asset_list(add, delete, clear, data_table, ticker, amount):
-    if data_table == None:
-        portfolio_assets = pd.DataFrame(columns=['Ticker Symbol', 'Amount'])
-    else:
-        portfolio_assets = pd.read_json(data_table, orient='split')
+@metrics.callback('callback_update_asset_list')
+def update_asset_list(add, delete, clear, session_id, ticker, amount):
     ctx = callback_context
     buttonPressed = ctx.triggered[0]['prop_id'].split('.')[0]
+    ticker = (ticker or '').strip().upper()
+    message = None
     if buttonPressed == "addAssetButton":
-        if ticker in portfolio_assets.index:
-            portfolio_assets.loc[ticker] = [ticker, int(amount) + portfolio_assets.loc[ticker, 'Amount']]
+        # Tickers outside the universe are looked up with a download
+        if etl.ticker_exists(ticker):
+            session_store.add_asset(session_id, ticker, int(amount))
+            message = young_tickers_warning([ticker])
         else:
-            portfolio_assets.loc[ticker] = [ticker, int(amount)]
+            message = f'Could not find ticker {ticker}'
     if buttonPressed == "deleteAssetButton":
-        portfolio_assets.drop(ticker, inplace=True)
+        session_store.delete_asset(session_id, ticker)
     if buttonPressed == "clearButton":
-        portfolio_assets.drop(portfolio_assets.index, inplace=True)
+        session_store.clear(session_id)
 
+    amounts = session_store.get_amounts(session_id)
+    portfolio_assets = pd.DataFrame({'Ticker Symbol': amounts.index, 'Amount': amounts.values})
     return dbc.Table.from_dataframe(
         portfolio_assets,
         striped=True,
         bordered=True,
         hover=True,
         size='sm'
-        ), portfolio_assets.to_json(date_format='iso', orient='split')
+        ), dcc.Markdown(message)
 
 # Callback for saving the portfolio
 @callback(
@@ -181,27 +292,40 @@ def update_asset_list(add, delete, clear, data_table, ticker, amount):
             Output('not_found_tickers_save', 'children'),
             Output('already_exists_error', 'children'),
             [State('pf_name', 'value'),
-            State('session-data-table', 'data'),
             State('session-id', 'data'),
             Input('save_portfolio', 'n_clicks'),
             Input('remove_portfolio', 'n_clicks'),
-            Input('remove_all_portfolios', 'n_clicks')])
-
-def save_portfolio(pf_name, data_table, session_id, save, remove, remove_all):
+            Input('remove_all_portfolios', 'n_clicks')],
+            background=True,
+            manager=jobs.background_manager,
+            running=[
+                (Output('save_portfolio', 'disabled'), True, False),
+                (Output('cancel_save', 'style'), {'display': 'inline-block'}, {'display': 'none'}),
+                (Output('save_progress', 'style'), {'display': 'flex'}, {'display': 'none'}),
+            ],
+            cancel=[Input('cancel_save', 'n_clicks')],
+            progress=[Output('save_progress', 'value'), Output('save_progress', 'label')],
+            progress_default=[0, ''])
+
+@metrics.callback('callback_save_portfolio')
+def save_portfolio(set_progress, pf_name, session_id, save, remove, remove_all):
     not_found_tickers = set()
     saved_pf_ids = etl.get_portfolio_names(session_id=session_id)
     saved_pf_ids.loc['current'] = 'Current'
     no_tickers_error = None
     already_exists_error = None
-    if data_table == None:
-        portfolio_assets = pd.DataFrame(columns=['Ticker Symbol', 'Amount'])
-    else:
-        portfolio_assets = pd.read_json(data_table, orient='split')
+    young_warning = None
     ctx = callback_context
     buttonPressed = ctx.triggered[0]['prop_id'].split('.')[0]
     if buttonPressed == "save_portfolio":
         if pf_name not in saved_pf_ids.values:
-            not_found_tickers = etl.save_portfolio_to_db(contribution=portfolio_assets['Amount'], portfolio_id=pf_name,session_id=session_id)
+            set_progress((30, 'Calculating key figures'))
+            contribution = session_store.get_amounts(session_id)
+            try:
+                not_found_tickers = etl.save_portfolio_to_db(contribution=contribution, portfolio_id=pf_name,session_id=session_id)
+                young_warning = young_tickers_warning(contribution.index.difference(list(not_found_tickers)).tolist())
+            except etl.PortfolioExistsError:
+                already_exists_error = f'Error when saving the portfolio > Portfolio {pf_name} already exists'
             saved_pf_ids = etl.get_portfolio_names(session_id=session_id)
             saved_pf_ids.loc['current'] = 'Current'
         else:
@@ -211,6 +335,8 @@ def save_portfolio(pf_name, data_table, session_id, save, remove, remove_all):
             no_tickers_error = f'Error when saving the portfolio > Could not find ticker(s): {not_found_tickers}'
         else:
             no_tickers_error = None
+        if young_warning:
+            no_tickers_error = '\n\n'.join(filter(None, [no_tickers_error, young_warning]))
     
     if buttonPressed == "remove_portfolio":
         etl.remove_portfolio_from_db(portfolio_id=pf_name,session_id=session_id)
@@ -225,120 +351,134 @@ def save_portfolio(pf_name, data_table, session_id, save, remove, remove_all):
 
 # Callback for the graphs and data table
 @callback(
-    Output(component_id= "graph", component_property= "figure"),
+    Output(component_id= "projection-params", component_property= "data"),
     Output(component_id= "breakdown", component_property= "children"),
     Output(component_id="pie-chart", component_property="figure"),
     Output(component_id="not_found_tickers", component_property="children"),
+    Output(component_id="backtest-graph", component_property="figure"),
+    Output(component_id="rolling-stats", component_property="data"),
+    Output(component_id="rolling_series", component_property="options"),
     [Input('createPortfolio', 'n_clicks'),
-    State('session-data-table', 'data'),
     State('session-id', 'data'),
     State(component_id= "years", component_property= "value"),
     State(component_id= "confidence", component_property= "value"),
-    State(component_id= "portfolio_id",component_property= "value")])
-
-def updatePlot(update, data_table, session_id, years, confidence, portfolio_id):
-    startDate = dt.datetime.now()
-    endDate = startDate + dt.timedelta(days= int(years)*365)
-    #Confidence level
-    if confidence == '50%':
-        z = 0.675
-    if confidence == '90%':
-        z = 1.645
-    if confidence == '95%':
-        z = 1.960
-    if confidence == '99%':
-        z = 2.576
-
-    if data_table == None:
-        portfolio_assets = pd.DataFrame(columns=['Ticker Symbol', 'Amount'])
-    else:
-        portfolio_assets = pd.read_json(data_table, orient='split')
+    State(component_id= "portfolio_id",component_property= "value"),
+    State(component_id= "projection_method",component_property= "value")],
+    background=True,
+    manager=jobs.background_manager,
+    running=[
+        (Output('createPortfolio', 'disabled'), True, False),
+        (Output('cancel_plot', 'style'), {'display': 'inline-block'}, {'display': 'none'}),
+        (Output('plot_progress', 'style'), {'display': 'flex'}, {'display': 'none'}),
+    ],
+    cancel=[Input('cancel_plot', 'n_clicks')],
+    progress=[Output('plot_progress', 'value'), Output('plot_progress', 'label')],
+    progress_default=[0, ''])
+
+@metrics.callback('callback_update_plot')
+def updatePlot(set_progress, update, session_id, years, confidence, portfolio_id, projection_method):
+    set_progress((10, 'Loading portfolio'))
+    # Outputs are cached by portfolio content. The log-normal chart is drawn in
+    # the browser, so years and confidence only matter for simulations.
+    plot_params = (projection_method, years, confidence) if projection_method == 'monte_carlo' else (projection_method,)
     if portfolio_id == 'Current':
-        portfolio, not_found_tickers = etl.calculate_key_figures(portfolio_assets['Amount'])
+        # Key figures of the current portfolio follow the daily prices
+        contribution = session_store.get_amounts(session_id)
+        cache_key = result_cache.make_key(contribution, dt.date.today().isoformat(), *plot_params)
+        cached_outputs = result_cache.get(cache_key)
+        if cached_outputs is not None:
+            return cached_outputs
+        portfolio, not_found_tickers = etl.calculate_key_figures(contribution)
+        young_warning = young_tickers_warning(portfolio.index.drop('Portfolio').tolist())
         portfolio = portfolio.reset_index()
         portfolio.index = portfolio['index']
         portfolio.rename(columns={'index': 'ticker'}, inplace=True)
     else:
         portfolio = etl.get_saved_portfolio(portfolio_name=portfolio_id, session_id=session_id)
+        # Key figures are saved, but the backtest and rolling charts follow the daily prices
+        cache_key = result_cache.make_key(portfolio, dt.date.today().isoformat(), *plot_params)
+        cached_outputs = result_cache.get(cache_key)
+        if cached_outputs is not None:
+            return cached_outputs
         portfolio.index = portfolio['ticker']
         portfolio.drop('portfolio_id', axis=1, inplace=True)
         not_found_tickers = set()
-    growthRate = portfolio.loc["Portfolio","expected_return"]             
-    purchaseAmount = portfolio.loc["Portfolio","amount"]
-    volatility = portfolio.loc["Portfolio","historical_volatility"]
-
-    futurePrices, confidenceIntervalLow, confidenceIntervalHigh = etl.calculate_expected_returns(purchaseAmount,growthRate,volatility,int(years),z)
-    #plotting
-    x = pd.date_range(startDate,endDate).tolist()
-    x_rev = x[::-1]
-
-    fig = go.Figure()
-
-    fig.add_trace(go.Scatter(
-        x= x+x_rev,
-        y=list(confidenceIntervalLow)+list(futurePrices)[::-1],
-        fill='toself',
-        fillcolor='rgba(100,0,0,0.2)',
-        line_color='rgba(255,255,255,0)',
-        showlegend=False,
-        name= confidence +'Confidence level',
-    ))
-
-    fig.add_trace(go.Scatter(
-        x= x+x_rev,
-        y=list(confidenceIntervalHigh)+list(futurePrices)[::-1],
-        fill='toself',
-        fillcolor='rgba(0,100,80,0.2)',
-        line_color='rgba(255,255,255,0)',
-        showlegend=False,
-        name= confidence +'Confidence level',
-    ))
-
-    fig.add_trace(go.Scatter(
-        x=x, y=futurePrices,
-        line_color='rgb(0,100,80)',
-        name='Portfolio',
-    ))
-
-    fig.add_trace(go.Scatter(
-        x=x, y=confidenceIntervalLow,
-        line_color='rgb(200,0,0)',
-        name='Lower bound',
-    ))
-
-    fig.add_trace(go.Scatter(
-        x=x, y=confidenceIntervalHigh,
-        line_color='rgb(0,200,160)',
-        name='Upper bound',
-    ))
-
-    fig.update_traces(mode='lines')
-
+        young_warning = None
+
+    # The log-normal fan chart is drawn by projection.fanChart in the browser
+    # from these three numbers, and redrawn there when years or confidence change
+    projection_params = {
+        'amount': float(portfolio.loc["Portfolio","amount"]),
+        'expected_return': float(portfolio.loc["Portfolio","expected_return"]),
+        'volatility': float(portfolio.loc["Portfolio","historical_volatility"]),
+    }
+    if projection_method == 'monte_carlo':
+        set_progress((50, 'Simulating'))
+        futurePrices, confidenceIntervalLow, confidenceIntervalHigh = etl.calculate_simulated_returns(portfolio,int(years),int(confidence.strip('%'))/100)
+        days = decimate_days(len(futurePrices))
+        projection_params['confidence'] = confidence
+        projection_params['bands'] = {
+            'days': days.tolist(),
+            'median': futurePrices[days-1].tolist(),
+            'low': confidenceIntervalLow[days-1].tolist(),
+            'high': confidenceIntervalHigh[days-1].tolist(),
+        }
+
+    set_progress((70, 'Backtesting'))
+    with metrics.span('figure'):
+        backtest = backtest_figure(portfolio.drop('Portfolio')['amount'])
+
+    set_progress((80, 'Calculating rolling risk'))
+    rolling = rolling_chart_data(portfolio.drop('Portfolio')['amount'])
+    rolling_options = [] if rolling is None else [{'label': name, 'value': name} for name in rolling['series']]
+
+    set_progress((90, 'Building charts'))
     portfolio = portfolio.round(4).sort_values(by='amount', ascending=True)
     pieData = portfolio.drop('Portfolio')
 
-    pie = go.Figure(go.Pie(
-        name = "Portfolio composition",
-        values = pieData['amount'],
-        labels = pieData['historical_volatility']*100,
-        showlegend= False,
-        #hover_data= ['assetCAPM', 'volatility', 'beta'],
-        customdata= pieData['expected_return'],
-        text= pieData.index,
-        hole= 0.5,
-        hovertemplate = "Expected return:%{customdata}: <br>Contribution: %{value} </br>Volatility:%{label}<br>Ticker:%{text}",
+    with metrics.span('figure'):
+        pie = go.Figure(go.Pie(
+            name = "Portfolio composition",
+            values = pieData['amount'],
+            labels = pieData['historical_volatility']*100,
+            showlegend= False,
+            #hover_data= ['assetCAPM', 'volatility', 'beta'],
+            customdata= pieData['expected_return'],
+            text= pieData.index,
+            hole= 0.5,
+            hovertemplate = "Expected return:%{customdata}: <br>Contribution: %{value} </br>Volatility:%{label}<br>Ticker:%{text}",
         
-    ))
+        ))
     if len(not_found_tickers):
         error_message = f'Error when plotting the portfolio > Could not find ticker(s): {not_found_tickers}'
     else:
         error_message = None
+    if young_warning:
+        error_message = '\n\n'.join(filter(None, [error_message, young_warning]))
     
     portfolio.columns = portfolio.columns.str.replace('_', ' ').str.capitalize()
-    return fig, dbc.Table.from_dataframe(
-        portfolio,
-        striped=True,
-        bordered=True,
-        hover=True,
-        size='sm'
-        ), pie, dcc.Markdown(error_message)
\ No newline at end of file
+    with metrics.span('figure'):
+        outputs = projection_params, dbc.Table.from_dataframe(
+            portfolio,
+            striped=True,
+            bordered=True,
+            hover=True,
+            size='sm'
+            ), pie, dcc.Markdown(error_message), backtest, rolling, rolling_options
+    # Tickers missing because of a failed download should be retried next time
+    if not len(not_found_tickers):
+        result_cache.put(cache_key, outputs, session_id, portfolio_id)
+    return outputs
+
+clientside_callback(
+    ClientsideFunction(namespace='projection', function_name='fanChart'),
+    Output(component_id= "graph", component_property= "figure"),
+    Input('projection-params', 'data'),
+    Input(component_id= "years", component_property= "value"),
+    Input(component_id= "confidence", component_property= "value"))
+
+clientside_callback(
+    ClientsideFunction(namespace='rolling', function_name='chart'),
+    Output(component_id= "rolling-graph", component_property= "figure"),
+    Input('rolling-stats', 'data'),
+    Input(component_id= "rolling_series", component_property= "value"))
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import fcntl
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from dotenv import load_dotenv
+
+import price_store
+
+load_dotenv()
+
+# Adjusted closes of the tickers read so far, a float64 column per ticker
+# over the union of their dates with NaN where a ticker did not trade. The
+# columns live in immutable Arrow IPC segment files listed by a manifest.
+# Every worker maps the segments, so their pages are shared through the page
+# cache and columns are read as zero-copy numpy views. A refresh writes the
+# changed columns to a new segment and swaps in a new manifest; readers keep
+# the mappings they hold until they see the new manifest.
+manifest_path = os.path.join(price_store.store_dir, 'panel.json')
+# Refreshes of all workers are serialized on this file
+lock_path = os.path.join(price_store.store_dir, 'panel.lock')
+# Segments end in slack_rows rows of NaN, so dates appended to the panel,
+# such as a new trading day, fit into the segments already written. Once
+# they do not, or beyond max_segments, all columns are compacted into one.
+slack_rows = int(os.getenv('PRICE_PANEL_SLACK_ROWS', 64))
+max_segments = int(os.getenv('PRICE_PANEL_MAX_SEGMENTS', 8))
+# Tickers not fetched for idle_seconds, and the least recently fetched beyond
+# max_tickers, are evicted when the panel is written
+idle_seconds = float(os.getenv('PRICE_PANEL_IDLE_SECONDS', 30*24*3600))
+max_tickers = int(os.getenv('PRICE_PANEL_MAX_TICKERS', 5000))
+
+# Replaced as a whole when a new manifest is read, so readers always see one
+# consistent panel. modified holds the store mtime each column was read at,
+# and start the first date every column holds, if it was trimmed.
+_panel = {'file_id': None, 'dates': pd.DatetimeIndex([]), 'columns': {}, 'modified': {}, 'start': None,
+          'segments': {}, 'owners': {}, 'dates_segment': None}
+
+def _file_id() -> tuple:
+    try:
+        stat = os.stat(manifest_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+def _segment_path(segment:str) -> str:
+    return os.path.join(price_store.store_dir, segment)
+
+def _load() -> dict:
+    """
+    Returns the current panel, mapping the segments again if the manifest has
+    been swapped since it was last read by this process.
+    """
+    global _panel
+    while True:
+        file_id = _file_id()
+        if file_id is None or file_id == _panel['file_id']:
+            return _panel
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        try:
+            tables = {segment: pa.ipc.open_file(pa.memory_map(_segment_path(segment))).read_all() for segment in manifest['segments']}
+        except FileNotFoundError:
+            # Compacted away after the manifest was read, read the new one
+            continue
+        length = manifest['length']
+        _panel = {
+            'file_id': file_id,
+            'dates': pd.DatetimeIndex(tables[manifest['dates_segment']].column('date').to_numpy()[:length]),
+            'columns': {ticker: tables[segment].column(ticker).chunk(0).to_numpy(zero_copy_only=True)[:length]
+                        for ticker, segment in manifest['owners'].items()},
+            'modified': manifest['modified'],
+            'start': None if manifest['start'] is None else pd.Timestamp(manifest['start']),
+            'segments': manifest['segments'],
+            'owners': manifest['owners'],
+            'dates_segment': manifest['dates_segment'],
+        }
+        return _panel
+
+def _write_segment(dates:pd.DatetimeIndex, columns:dict) -> str:
+    """
+    Writes the columns, aligned to dates, followed by slack_rows rows of NaN
+    to a new segment file and returns its name.
+    """
+    segment = f'panel-{time.time_ns()}-{os.getpid()}.arrow'
+    padded_dates = np.concatenate([dates.values, np.full(slack_rows, np.datetime64('NaT'), dtype=dates.values.dtype)])
+    table = pa.table({'date': padded_dates, **{ticker: np.concatenate([column, np.full(slack_rows, np.nan)]) for ticker, column in columns.items()}})
+    # Write to a temporary file first so readers never map a partial file
+    path = _segment_path(segment)
+    tmp_path = f'{path}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_path, path)
+    return segment
+
+def _kept(panel:dict, prices:dict, requested:list) -> list:
+    """
+    Returns the tickers of the panel to keep besides those in prices: the
+    requested ones, and of the others the ones fetched within idle_seconds,
+    at most max_tickers in all.
+    """
+    now = time.time()
+    requested = [ticker for ticker in requested if ticker in panel['columns'] and ticker not in prices]
+    fetched = {ticker: price_store.fetched_at(ticker) or 0 for ticker in panel['columns'] if ticker not in prices and ticker not in requested}
+    kept = sorted((ticker for ticker, at in fetched.items() if now - at < idle_seconds), key=lambda ticker: -fetched[ticker])
+    return requested + kept[:max(max_tickers - len(prices) - len(requested), 0)]
+
+def _write(panel:dict, prices:dict, modified:dict, requested:list):
+    """
+    Writes the prices as a new segment and swaps in a manifest with them in
+    place of the columns they replace, without copying the columns of other
+    tickers, and evicts the tickers _kept does not keep. When the dates of the
+    panel change other than by appending within the slack, or there would be
+    more than max_segments, or the panel holds dates more than trim_days
+    before price_store.trim_start, every column is copied into one segment
+    starting at trim_start instead.
+    """
+    trim_start = price_store.trim_start()
+    kept = _kept(panel, prices, requested)
+    dates = panel['dates']
+    for series in prices.values():
+        dates = dates.union(series.index)
+    segments = {panel['owners'][ticker] for ticker in kept}
+    capacity = min((panel['segments'][segment] for segment in segments), default=np.inf)
+
+    compact = (
+        not dates[:len(panel['dates'])].equals(panel['dates'])
+        or len(dates) > capacity
+        or len(segments) + 1 > max_segments
+        or (len(dates) > 0 and dates[0] < trim_start - pd.Timedelta(days=price_store.trim_days))
+    )
+    if compact:
+        dates = dates[dates >= trim_start]
+        columns = {ticker: pd.Series(panel['columns'][ticker], index=panel['dates']).reindex(dates).to_numpy() for ticker in kept}
+        columns.update({ticker: series.reindex(dates).to_numpy(np.float64) for ticker, series in prices.items()})
+        owners = dict.fromkeys(columns, _write_segment(dates, columns))
+    else:
+        columns = {ticker: series.reindex(dates).to_numpy(np.float64) for ticker, series in prices.items()}
+        owners = {ticker: panel['owners'][ticker] for ticker in kept}
+        owners.update(dict.fromkeys(columns, _write_segment(dates, columns)))
+    dates_segment = owners[next(iter(prices))]
+    live = {segment: panel['segments'].get(segment, len(dates) + slack_rows) for segment in {*owners.values(), dates_segment}}
+    # Every column holds the dates from the latest trim_start on
+    start = trim_start if panel['start'] is None else max(panel['start'], trim_start)
+    manifest = {
+        'segments': live,
+        'owners': owners,
+        'dates_segment': dates_segment,
+        'length': len(dates),
+        'modified': {**{ticker: panel['modified'][ticker] for ticker in kept}, **modified},
+        'start': start.isoformat(),
+    }
+
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, manifest_path)
+    # Readers holding the old segments keep their mappings
+    for segment in set(panel['segments']) - set(live):
+        os.remove(_segment_path(segment))
+
+def update(tickers:list) -> dict:
+    """
+    Brings the columns of the tickers up to date with the price store, adding
+    those the panel does not hold yet, and returns the panel. Tickers the
+    store does not have are left out.
+    """
+    modified = {ticker: price_store.modified_at(ticker) for ticker in dict.fromkeys(tickers)}
+    modified = {ticker: modified_time for ticker, modified_time in modified.items() if modified_time is not None}
+    panel = _load()
+    if all(panel['modified'].get(ticker) == modified_time for ticker, modified_time in modified.items()):
+        return panel
+
+    os.makedirs(price_store.store_dir, exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Another worker may have added the columns while this one waited
+        panel = _load()
+        stale = {ticker: price_store.modified_at(ticker) for ticker in modified if panel['modified'].get(ticker) != price_store.modified_at(ticker)}
+        if stale:
+            # Read after taking the mtime, so a write in between is caught by the next update
+            _write(panel, {ticker: price_store.read_ticker(ticker) for ticker in stale}, stale, list(modified))
+            panel = _load()
+    return panel
+
+def get_columns(tickers:list) -> (pd.DatetimeIndex, dict):
+    """
+    Returns the dates of the history window and the adjusted closes of the
+    tickers over them as read-only views into the mapped panel, after
+    bringing the store and the panel up to date. Tickers that could not be
+    found are left out.
+    """
+    price_store.update_store(tickers)
+    panel = update(tickers)
+    window_start = pd.Timestamp.now().normalize() - pd.DateOffset(years=price_store.history_years)
+    window = slice(panel['dates'].searchsorted(window_start), None)
+    columns = {ticker: panel['columns'][ticker][window] for ticker in dict.fromkeys(tickers) if ticker in panel['columns']}
+    return panel['dates'][window], columns
+
+def get_adj_close(tickers:list) -> pd.DataFrame:
+    """
+    Returns the Adj Close frame of price_store.get_adj_close read from the
+    panel. Only the columns of the tickers are copied.
+    """
+    dates, columns = get_columns(tickers)
+    prices = pd.DataFrame(columns, index=dates)
+    return prices.dropna(axis=0, how='all')
+
+def read_ticker(ticker:str, panel:dict=None) -> pd.Series:
+    """
+    Returns the whole stored history of a ticker the panel holds as a
+    zero-copy Series, NaN on the dates it did not trade, or None. Reads the
+    current panel unless one returned by update is given.
+    """
+    panel = panel or _load()
+    if ticker not in panel['columns']:
+        return None
+    return pd.Series(panel['columns'][ticker], index=panel['dates'], name=ticker, copy=False)
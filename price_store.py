@@ -0,0 +1,249 @@
+import os
+import time
+import threading
+from concurrent.futures import Future
+import pandas as pd
+from dotenv import load_dotenv
+
+import fetcher
+import metrics
+
+load_dotenv()
+
+# Local columnar store for daily adjusted closes, one Parquet file per ticker
+store_dir = os.getenv('PRICE_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.price_store'))
+# A ticker fetched within this many seconds is considered up to date
+refresh_seconds = float(os.getenv('PRICE_STORE_REFRESH_SECONDS', 3600))
+# Yahoo rescales the whole adjusted history after a split or a dividend. A
+# tail whose first close differs from the stored one by more than this
+# relative tolerance means the stored history is on an old basis.
+adjustment_tolerance = float(os.getenv('PRICE_STORE_ADJUSTMENT_TOLERANCE', 1e-4))
+history_years = 5
+# Days of history kept before the window. Statistics updated incrementally
+# subtract the days that left the window, so these must still be readable.
+trim_days = 92
+# Concurrent callers arriving within this window share one batched download
+coalesce_seconds = float(os.getenv('PRICE_STORE_COALESCE_SECONDS', 0.05))
+
+# Tickers being downloaded right now, each with the Future its callers wait on
+_flight_lock = threading.Lock()
+_in_flight = {}
+_pending = []
+_leader_active = False
+
+def _reset_after_fork():
+    # Downloads in flight belong to threads of the parent process
+    global _flight_lock, _in_flight, _pending, _leader_active
+    _flight_lock = threading.Lock()
+    _in_flight = {}
+    _pending = []
+    _leader_active = False
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def trim_start() -> pd.Timestamp:
+    """
+    Returns the first date the store keeps, trim_days before the history
+    window.
+    """
+    return pd.Timestamp.now().normalize() - pd.DateOffset(years=history_years) - pd.Timedelta(days=trim_days)
+
+def _ticker_path(ticker:str) -> str:
+    return os.path.join(store_dir, ticker.replace('/', '_') + '.parquet')
+
+def _fetched_path(ticker:str) -> str:
+    return _ticker_path(ticker) + '.fetched'
+
+def read_ticker(ticker:str) -> pd.Series:
+    """
+    Returns the stored adjusted close series of the ticker indexed by date,
+    or None if the ticker has never been fetched.
+    """
+    path = _ticker_path(ticker)
+    if not os.path.exists(path):
+        return None
+    frame = pd.read_parquet(path)
+    return frame.set_index('date')['adj_close'].rename(ticker)
+
+def write_ticker(ticker:str, prices:pd.Series, replace:bool=False):
+    """
+    Merges new closes into the stored series, or with replace stores them
+    instead of it. Newer values win for dates that already exist, since the
+    last cached close may have been intraday. Dates before trim_start are
+    dropped, so the store does not grow beyond the window.
+
+    The file is only rewritten when the merged series differs from the stored
+    one, so its mtime, which readers compare to detect changed prices, only
+    moves when the prices do. The fetch itself is recorded in a separate
+    marker file.
+    """
+    prices = prices.dropna()
+    if getattr(prices.index, 'tz', None) is not None:
+        prices.index = prices.index.tz_localize(None)
+    stored = read_ticker(ticker)
+    if stored is not None and not replace:
+        prices = pd.concat([stored, prices])
+        prices = prices[~prices.index.duplicated(keep='last')]
+    prices = prices.sort_index()
+    prices = prices[prices.index >= trim_start()]
+
+    os.makedirs(store_dir, exist_ok=True)
+    if stored is None or not (prices.index.equals(stored.index) and (prices.values == stored.values).all()):
+        frame = pd.DataFrame({'date': prices.index, 'adj_close': prices.values})
+        # Write to a temporary file first so readers never see a partial file
+        path = _ticker_path(ticker)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    with open(_fetched_path(ticker), 'a'):
+        os.utime(_fetched_path(ticker))
+
+def modified_at(ticker:str) -> float:
+    """
+    Returns the time the prices of the ticker last changed in the store, or
+    None.
+    """
+    path = _ticker_path(ticker)
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+def fetched_at(ticker:str) -> float:
+    """
+    Returns the time the ticker was last fetched, or None.
+    """
+    path = _fetched_path(ticker)
+    return os.path.getmtime(path) if os.path.exists(path) else modified_at(ticker)
+
+def first_trading_date(ticker:str) -> pd.Timestamp:
+    """
+    Returns the first stored close of a ticker that started trading within
+    the history window, or None. The full window is downloaded on first use,
+    so a stored history that starts more than a week into the window belongs
+    to a young ticker.
+    """
+    prices = read_ticker(ticker)
+    window_start = pd.Timestamp.now().normalize() - pd.DateOffset(years=history_years)
+    if prices is None or prices.empty or prices.index.min() <= window_start + pd.Timedelta(days=7):
+        return None
+    return prices.index.min()
+
+def is_fresh(ticker:str) -> bool:
+    fetched = fetched_at(ticker)
+    return fetched is not None and time.time() - fetched < refresh_seconds
+
+def _is_rebased(stored:pd.Series, prices:pd.Series) -> bool:
+    """
+    Returns whether the fetched tail is on another adjustment basis than the
+    stored history, compared on the first day of the tail, which the store
+    already holds as a final close.
+    """
+    overlap = prices.index.min()
+    if overlap not in stored.index:
+        return True
+    stored_close = stored[overlap]
+    return abs(prices[overlap] - stored_close) > adjustment_tolerance * abs(stored_close)
+
+def _fetch_batch(tickers:list):
+    """
+    Downloads the tail of every ticker through the fetcher and resolves the
+    Futures of everyone waiting on them. Tickers the fetcher could not deliver
+    keep whatever history the store already has.
+
+    Each tail starts on the second to last stored day, whose close is final,
+    so the day can be compared with the store. Tickers whose adjusted closes
+    were rescaled since are downloaded again for the full window, which then
+    replaces the stored history.
+    """
+    stored = {ticker: read_ticker(ticker) for ticker in tickers}
+    starts = {}
+    for ticker in tickers:
+        history = stored[ticker]
+        starts[ticker] = None if history is None or history.empty else history.index[max(len(history) - 2, 0)].date()
+
+    try:
+        adj_close = fetcher.fetch_adj_close(starts)
+        rebased = []
+        for ticker in tickers:
+            if ticker in adj_close.columns and adj_close[ticker].notna().any():
+                prices = adj_close[ticker].dropna()
+                if starts[ticker] is not None and _is_rebased(stored[ticker], prices):
+                    rebased.append(ticker)
+                else:
+                    write_ticker(ticker, prices)
+        if rebased:
+            metrics.count('price_store_rebased', len(rebased))
+            adj_close = fetcher.fetch_adj_close({ticker: None for ticker in rebased})
+            for ticker in rebased:
+                if ticker in adj_close.columns and adj_close[ticker].notna().any():
+                    write_ticker(ticker, adj_close[ticker], replace=True)
+        error = None
+    except Exception as raised:
+        error = raised
+    finally:
+        with _flight_lock:
+            futures = [_in_flight.pop(ticker) for ticker in tickers]
+    for future in futures:
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+def update_store(tickers:list, force:bool=False):
+    """
+    Fetches only the missing tail of each stale ticker. With force the tail
+    is fetched even if the ticker was refreshed recently.
+
+    Downloads are single-flight: a ticker already being fetched by another
+    thread is waited on instead of fetched again. The first caller waits
+    coalesce_seconds and then downloads everything requested in the meantime,
+    so overlapping ticker sets are merged into one batch for the fetcher.
+    """
+    global _leader_active
+    waiting = []
+    leader = False
+    fetched = 0
+    with _flight_lock:
+        for ticker in set(tickers):
+            if ticker in _in_flight:
+                waiting.append(_in_flight[ticker])
+            elif force or not is_fresh(ticker):
+                _in_flight[ticker] = Future()
+                _pending.append(ticker)
+                waiting.append(_in_flight[ticker])
+                fetched += 1
+        if _pending and not _leader_active:
+            _leader_active = leader = True
+    metrics.count('price_store_hit', len(set(tickers)) - fetched)
+    metrics.count('price_store_miss', fetched)
+
+    if leader:
+        time.sleep(coalesce_seconds)
+        with _flight_lock:
+            batch = _pending.copy()
+            _pending.clear()
+            _leader_active = False
+        _fetch_batch(batch)
+
+    for future in waiting:
+        future.result()
+
+def read_adj_close(tickers:list) -> pd.DataFrame:
+    """
+    Returns the Adj Close frame of the tickers over the history window as the
+    store holds it, without fetching. Tickers never fetched are left out.
+    """
+    window_start = pd.Timestamp.now().normalize() - pd.DateOffset(years=history_years)
+    columns = {}
+    for ticker in dict.fromkeys(tickers):
+        stored = read_ticker(ticker)
+        if stored is not None:
+            columns[ticker] = stored[stored.index >= window_start]
+    return pd.DataFrame(columns)
+
+def get_adj_close(tickers:list, force:bool=False) -> pd.DataFrame:
+    """
+    Returns the Adj Close frame of the tickers over the history window, built
+    from the store after bringing it up to date. Tickers that could not be
+    found are left out of the frame.
+    """
+    update_store(tickers, force=force)
+    return read_adj_close(tickers)
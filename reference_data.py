@@ -0,0 +1,116 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+import pandas as pd
+from dotenv import load_dotenv
+
+import price_store
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# ACWI or All Country Wide Index is an index with global equity exposure
+# and used here as the market. 13 week treasury bill yield is the risk free rate.
+market_ticker = 'ACWI'
+risk_free_ticker = '^IRX'
+
+# The background thread refreshes the data every refresh_seconds. Readers
+# fetch synchronously only if the data is older than max_age_seconds.
+refresh_seconds = float(os.getenv('REFERENCE_DATA_REFRESH_SECONDS', 900))
+max_age_seconds = float(os.getenv('REFERENCE_DATA_MAX_AGE_SECONDS', 3600))
+
+# Processes refresh one at a time, and a process finding the data fetched
+# within refresh_seconds by another one reads it from the store instead
+lock_path = os.path.join(price_store.store_dir, 'reference_data.lock')
+
+_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_market = None
+_risk_free_rate = None
+_refreshed_at = 0.0
+_refresher_pid = None
+
+def _reset_after_fork():
+    global _lock, _refresh_lock
+    _lock = threading.Lock()
+    _refresh_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _update_store():
+    os.makedirs(price_store.store_dir, exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        fetched = [price_store.fetched_at(ticker) for ticker in (market_ticker, risk_free_ticker)]
+        if any(at is None or time.time() - at >= refresh_seconds for at in fetched):
+            price_store.update_store([market_ticker, risk_free_ticker], force=True)
+
+def refresh(max_age:float=0):
+    """
+    Brings the market series and the risk free rate up to date and swaps
+    them in for all readers of the process. Threads arriving while another
+    one refreshes wait for it, and skip their own refresh if the data is now
+    younger than max_age.
+
+    If the download fails the last values in the store are served instead,
+    and the error is only raised when the store has none.
+    """
+    global _market, _risk_free_rate, _refreshed_at
+    with _refresh_lock:
+        if _market is not None and time.time() - _refreshed_at < max_age:
+            return
+        error = None
+        try:
+            _update_store()
+        except Exception as raised:
+            error = raised
+        prices = price_store.read_adj_close([market_ticker, risk_free_ticker])
+        if market_ticker not in prices.columns or risk_free_ticker not in prices.columns:
+            raise error or LookupError('The price store has no reference data')
+        if error is not None:
+            logger.warning('Reference data refresh failed, serving the stored values: %s', error)
+        market = prices[market_ticker].dropna()
+        risk_free_rate = prices[risk_free_ticker].dropna().values[-1] / 100
+        with _lock:
+            _market = market
+            _risk_free_rate = risk_free_rate
+            _refreshed_at = time.time()
+
+def is_stale() -> bool:
+    return _market is None or time.time() - _refreshed_at > max_age_seconds
+
+def _refresh_loop():
+    while True:
+        time.sleep(refresh_seconds)
+        try:
+            refresh()
+        except Exception:
+            logger.exception('Reference data refresh failed')
+
+def start_refresher():
+    """
+    Starts the background refresher once per process. Checked against the pid
+    so that forked gunicorn workers start their own thread.
+    """
+    global _refresher_pid
+    with _lock:
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+    threading.Thread(target=_refresh_loop, name='reference-data-refresher', daemon=True).start()
+
+def _ensure_fresh():
+    if is_stale():
+        refresh(max_age=max_age_seconds)
+    start_refresher()
+
+def get_market() -> pd.Series:
+    _ensure_fresh()
+    return _market
+
+def get_risk_free_rate() -> float:
+    _ensure_fresh()
+    return _risk_free_rate
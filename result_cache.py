@@ -0,0 +1,42 @@
+import os
+import hashlib
+import pickle
+import disk_cache
+import pandas as pd
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+# Callback outputs shared by all gunicorn workers and background jobs,
+# evicted by least recent use above the size limit and after the ttl
+cache_dir = os.getenv('RESULT_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.result_cache'))
+ttl_seconds = float(os.getenv('RESULT_CACHE_TTL_SECONDS', 3600))
+size_limit = int(os.getenv('RESULT_CACHE_SIZE_LIMIT', 256 * 2**20))
+
+cache = disk_cache.Cache(cache_dir, eviction_policy='least-recently-used', size_limit=size_limit, tag_index=True)
+
+def make_key(content, *params) -> str:
+    """
+    Returns a key for the content, a DataFrame or Series, and the parameters
+    the outputs were built with. Equal content gives equal keys regardless of
+    the session or name it was loaded under.
+    """
+    digest = hashlib.sha256(pd.util.hash_pandas_object(content, index=True).values.tobytes())
+    digest.update(pickle.dumps(params))
+    return digest.hexdigest()
+
+def portfolio_tag(session_id:str, portfolio_id:str) -> str:
+    return f'{session_id}/{portfolio_id}'
+
+def get(key:str):
+    outputs = cache.get(key)
+    metrics.count('result_cache_miss' if outputs is None else 'result_cache_hit')
+    return outputs
+
+def put(key:str, outputs, session_id:str, portfolio_id:str):
+    cache.set(key, outputs, expire=ttl_seconds, tag=portfolio_tag(session_id, portfolio_id))
+
+def invalidate(session_id:str, portfolio_id:str):
+    cache.evict(portfolio_tag(session_id, portfolio_id))
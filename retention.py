@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+import datetime as dt
+import threading
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+import db
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Saved portfolios of sessions not used for ttl_days are purged by dropping
+# the day partitions of portfolio_builder.portfolios they were saved in
+ttl_days = int(os.getenv('SESSION_DATA_TTL_DAYS', 30))
+purge_interval_seconds = float(os.getenv('SESSION_PURGE_INTERVAL_SECONDS', 3600))
+# Partitions are created this many days ahead, so saves rarely land in the
+# default partition
+days_ahead = 3
+
+# Only one process purges at a time, the others skip the run
+purge_lock_statement = text("select pg_try_advisory_xact_lock(hashtext('session_purge'))")
+
+partitions_query = text("""
+    select child.relname
+    from pg_inherits
+    join pg_class parent on parent.oid = pg_inherits.inhparent
+    join pg_class child on child.oid = pg_inherits.inhrelid
+    join pg_namespace on pg_namespace.oid = parent.relnamespace
+    where pg_namespace.nspname = 'portfolio_builder' and parent.relname = 'portfolios'
+    and child.relname like 'portfolios\\_p%'
+""")
+
+# Rows of sessions still in use are carried over to today's partition
+# before their old partition is dropped
+carry_over_statement = """
+    insert into portfolio_builder.portfolios ({columns}, saved_on)
+    select {columns}, :today from portfolio_builder.{partition} saved
+    where exists (
+        select 1 from portfolio_builder.sessions
+        where sessions.session_id = saved.session_id and sessions.last_used_at >= now() - make_interval(days => :ttl_days)
+    )
+"""
+
+purge_default_statement = text("""
+    delete from portfolio_builder.portfolios_default saved
+    where saved_on < current_date - :ttl_days
+    and not exists (
+        select 1 from portfolio_builder.sessions
+        where sessions.session_id = saved.session_id and sessions.last_used_at >= now() - make_interval(days => :ttl_days)
+    )
+""")
+
+purge_sessions_statement = text("""
+    delete from portfolio_builder.sessions
+    where last_used_at < now() - make_interval(days => :ttl_days)
+""")
+
+_lock = threading.Lock()
+_purger_pid = None
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def partition_name(day:dt.date) -> str:
+    return f'portfolios_p{day:%Y%m%d}'
+
+def _partition_day(name:str) -> dt.date:
+    return dt.datetime.strptime(name[len('portfolios_p'):], '%Y%m%d').date()
+
+def _create_partition(connection, day:dt.date):
+    """
+    Creates the partition of the day, moving in any rows of the day that
+    were saved to the default partition while it did not exist.
+    """
+    partition = partition_name(day)
+    columns = ', '.join(db.portfolio_columns + ['saved_on'])
+    next_day = day + dt.timedelta(days=1)
+    connection.execute(text(f'create table portfolio_builder.{partition} (like portfolio_builder.portfolios including defaults)'))
+    connection.execute(text(f"""
+        with moved as (
+            delete from portfolio_builder.portfolios_default
+            where saved_on >= :day and saved_on < :next_day
+            returning {columns}
+        )
+        insert into portfolio_builder.{partition} ({columns}) select {columns} from moved
+    """), {'day': day, 'next_day': next_day})
+    connection.execute(text(f"alter table portfolio_builder.portfolios attach partition portfolio_builder.{partition} for values from ('{day}') to ('{next_day}')"))
+
+def purge(today:dt.date=None) -> list:
+    """
+    Creates the partitions of today and the next days_ahead days, and drops
+    the partitions older than ttl_days after carrying over the rows of
+    sessions used within ttl_days. Sessions not used within ttl_days are
+    forgotten. Runs in one transaction and returns the partitions dropped,
+    or None if another process was purging at the same time.
+    """
+    today = today or dt.date.today()
+    cutoff = today - dt.timedelta(days=ttl_days)
+    dropped = []
+    with db.get_engine().begin() as connection:
+        if not connection.execute(purge_lock_statement).scalar():
+            return None
+        partitions = {_partition_day(row[0]): row[0] for row in connection.execute(partitions_query)}
+        for offset in range(days_ahead + 1):
+            day = today + dt.timedelta(days=offset)
+            if day not in partitions:
+                _create_partition(connection, day)
+
+        columns = ', '.join(db.portfolio_columns)
+        for day, partition in sorted(partitions.items()):
+            if day >= cutoff:
+                continue
+            connection.execute(text(carry_over_statement.format(columns=columns, partition=partition)), {'ttl_days': ttl_days, 'today': today})
+            connection.execute(text(f'alter table portfolio_builder.portfolios detach partition portfolio_builder.{partition}'))
+            connection.execute(text(f'drop table portfolio_builder.{partition}'))
+            dropped.append(partition)
+        connection.execute(purge_default_statement, {'ttl_days': ttl_days})
+        connection.execute(purge_sessions_statement, {'ttl_days': ttl_days})
+    return dropped
+
+def _purge_loop():
+    while True:
+        try:
+            purge()
+        except Exception:
+            logger.exception('Session data purge failed')
+        time.sleep(purge_interval_seconds)
+
+def start_purger():
+    """
+    Starts the background purger once per process, see gunicorn.conf.py.
+    Every worker runs one, but only one of them purges at a time.
+    """
+    global _purger_pid
+    with _lock:
+        if _purger_pid == os.getpid():
+            return
+        _purger_pid = os.getpid()
+    threading.Thread(target=_purge_loop, name='session-purger', daemon=True).start()
+
+if __name__ == '__main__':
+    print(f'dropped {purge()}')
@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from dotenv import load_dotenv
+
+import price_store
+import price_panel
+import reference_data
+
+load_dotenv()
+
+# Running sums of daily returns for every pair of tracked tickers, kept over
+# the same rolling window as the price history: the number of days both
+# tickers have a return on, the sum of the first ticker's returns on those
+# days and the sum of the products. The diagonal holds the statistics of a
+# single ticker. Next to the sums each ticker keeps the date and value of its
+# last return and the close that return is measured from, so an update only
+# reads the days that entered or left the window.
+stats_path = os.path.join(price_store.store_dir, 'risk_stats.arrow')
+# The least recently requested tickers are dropped beyond this many, the
+# sums take max_tickers**2 values each
+max_tickers = int(os.getenv('RISK_STATS_MAX_TICKERS', 1000))
+_sum_names = ('n', 'sum_a', 'sum_ab')
+_ticker_columns = ('modified', 'last_date', 'last_return', 'check_date', 'check_close', 'used_at')
+
+def _empty_state() -> dict:
+    return {
+        'window_start': None,
+        'tickers': pd.DataFrame({column: pd.Series(dtype='datetime64[ns]' if column.endswith('_date') else np.float64) for column in _ticker_columns}),
+        'sums': {name: np.zeros((0, 0)) for name in _sum_names},
+    }
+
+_lock = threading.Lock()
+_state = _empty_state()
+_loaded_mtime = None
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _load():
+    """
+    Reloads the statistics if another worker has written them since.
+    """
+    global _state, _loaded_mtime
+    if not os.path.exists(stats_path) or os.path.getmtime(stats_path) == _loaded_mtime:
+        return
+    table = pa.ipc.open_file(pa.OSFile(stats_path)).read_all()
+    n_tickers = table.num_rows
+    tickers = table.select(['ticker', *_ticker_columns]).to_pandas().set_index('ticker')
+    _state = {
+        'window_start': pd.Timestamp(json.loads(table.schema.metadata[b'window_start'])),
+        'tickers': tickers,
+        'sums': {name: table.column(name).combine_chunks().flatten().to_numpy().reshape(n_tickers, n_tickers).copy() for name in _sum_names},
+    }
+    _loaded_mtime = os.path.getmtime(stats_path)
+
+def _save():
+    global _loaded_mtime
+    tickers = _state['tickers']
+    columns = {'ticker': tickers.index.tolist(), **{column: tickers[column].values for column in _ticker_columns}}
+    for name in _sum_names:
+        columns[name] = pa.FixedSizeListArray.from_arrays(pa.array(_state['sums'][name].ravel()), max(len(tickers), 1))
+    table = pa.table(columns, metadata={'window_start': json.dumps(_state['window_start'].isoformat())})
+
+    os.makedirs(os.path.dirname(stats_path), exist_ok=True)
+    tmp_path = f'{stats_path}.{os.getpid()}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_path, stats_path)
+    _loaded_mtime = os.path.getmtime(stats_path)
+
+def _previous_close(column:np.ndarray, row:int) -> int:
+    """
+    Returns the row of the last close before row, or -1. Reads backwards a
+    few rows at a time, so only the gap before row is read.
+    """
+    while row > 0:
+        start = max(row - 16, 0)
+        closes = np.flatnonzero(~np.isnan(column[start:row]))
+        if len(closes):
+            return start + closes[-1]
+        row = start
+    return -1
+
+def _returns(column:np.ndarray, dates:np.ndarray, start:int, stop:int) -> (np.ndarray, np.ndarray):
+    """
+    Returns the daily returns of a panel column on the rows start:stop, NaN
+    where the ticker did not trade, and the dates of the closes they are
+    measured from. Each return is measured from the ticker's own previous
+    close.
+    """
+    returns = np.full(stop - start, np.nan)
+    previous_dates = np.full(stop - start, np.datetime64('NaT'), dtype=dates.dtype)
+    values = column[start:stop]
+    rows = np.flatnonzero(~np.isnan(values))
+    if len(rows):
+        previous_rows = np.concatenate([[_previous_close(column, start + rows[0])], start + rows[:-1]])
+        rows, previous_rows = rows[previous_rows >= 0], previous_rows[previous_rows >= 0]
+        returns[rows] = values[rows] / column[previous_rows] - 1
+        previous_dates[rows] = dates[previous_rows]
+    return returns, previous_dates
+
+def _pair_sums(left:np.ndarray, right:np.ndarray) -> dict:
+    """
+    Returns the sums of every pair of a column of the (days, tickers) left
+    returns and a column of the right returns over the days both have one.
+    """
+    left_valid, right_valid = ~np.isnan(left), ~np.isnan(right)
+    left_returns, right_returns = np.where(left_valid, left, 0.0), np.where(right_valid, right, 0.0)
+    return {
+        'n': left_valid.T.astype(np.float64) @ right_valid,
+        'sum_a': left_returns.T @ right_valid,
+        'sum_ab': left_returns.T @ right_returns,
+    }
+
+def _ticker_state(column:np.ndarray, dates:np.ndarray) -> dict:
+    """
+    Returns the date and value of the last return of a panel column and the
+    date and close it is measured from.
+    """
+    last_row = _previous_close(column, len(column))
+    check_row = _previous_close(column, last_row) if last_row >= 0 else -1
+    if check_row < 0:
+        return {'last_date': pd.NaT, 'last_return': np.nan, 'check_date': pd.NaT, 'check_close': np.nan}
+    return {
+        'last_date': dates[last_row],
+        'last_return': column[last_row] / column[check_row] - 1,
+        'check_date': dates[check_row],
+        'check_close': column[check_row],
+    }
+
+def _is_rebased(column:np.ndarray, dates:pd.DatetimeIndex, state:pd.Series) -> bool:
+    """
+    Returns whether the close the last return was measured from has changed,
+    as it does when the adjusted history is rescaled after a split or a
+    dividend, so that the sums of the ticker cannot be updated.
+    """
+    if pd.isna(state['check_date']):
+        return True
+    row = dates.searchsorted(state['check_date'])
+    return row == len(dates) or dates[row] != state['check_date'] or column[row] != state['check_close']
+
+def _next_close(column:np.ndarray, row:int) -> int:
+    """
+    Returns the row of the first close at or after row, or the length of the
+    column.
+    """
+    while row < len(column):
+        stop = min(row + 16, len(column))
+        closes = np.flatnonzero(~np.isnan(column[row:stop]))
+        if len(closes):
+            return row + closes[0]
+        row = stop
+    return len(column)
+
+def _update(panel:dict, found:list, window_start:pd.Timestamp):
+    """
+    Brings the sums of the tracked tickers and of the found tickers up to
+    date with the panel and the window.
+
+    For tickers tracked before, the days that left the window and the days
+    after each changed ticker's last return are read from the panel, and the
+    sums of those days are subtracted as they were and added as they are now,
+    so the cost is proportional to the number of changed days. Tickers that
+    are new, or whose history was rescaled, get their sums with every other
+    ticker from the whole window.
+    """
+    global _state
+    dates = panel['dates']
+    date_values = dates.values
+    columns = panel['columns']
+    tracked = _state['tickers']
+    tracked = tracked[tracked.index.isin(list(columns))]
+    rebased = [ticker for ticker, state in tracked.iterrows() if panel['modified'].get(ticker) != state['modified'] and _is_rebased(columns[ticker], dates, state)]
+    if _state['window_start'] is None or window_start < _state['window_start'] or (panel['start'] is not None and _state['window_start'] < panel['start']):
+        # A window reaching further back needs days that were never read, and
+        # days the panel no longer holds cannot be subtracted
+        rebased = tracked.index.tolist()
+    kept = tracked.drop(index=rebased)
+    positions = _state['tickers'].index.get_indexer(kept.index)
+    sums = {name: values[np.ix_(positions, positions)] for name, values in _state['sums'].items()}
+
+    if len(kept):
+        # Rows of the returns that left the window, up to each ticker's first
+        # close in the new window, and of the returns from each changed
+        # ticker's last return on
+        ranges = []
+        old_window_start = _state['window_start']
+        if window_start != old_window_start:
+            head_stop = max(_next_close(columns[ticker], dates.searchsorted(window_start)) for ticker in kept.index) + 1
+            ranges.append([dates.searchsorted(old_window_start), min(head_stop, len(dates))])
+        changed = kept[[panel['modified'].get(ticker) != modified for ticker, modified in kept['modified'].items()]]
+        if len(changed):
+            last_date = changed['last_date'].min() if changed['last_date'].notna().all() else old_window_start
+            ranges.append([dates.searchsorted(last_date), len(dates)])
+        ranges.sort()
+        merged = []
+        for start, stop in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+
+        for start, stop in merged:
+            old = np.full((stop - start, len(kept)), np.nan)
+            new = np.full((stop - start, len(kept)), np.nan)
+            for i, (ticker, state) in enumerate(kept.iterrows()):
+                returns, previous_dates = _returns(columns[ticker], date_values, start, stop)
+                in_old = (previous_dates >= old_window_start) & (date_values[start:stop] <= state['last_date'])
+                old[in_old, i] = returns[in_old]
+                # The last close may have been intraday and replaced since
+                last_row = dates.searchsorted(state['last_date']) - start
+                if not pd.isna(state['last_date']) and 0 <= last_row < stop - start and in_old[last_row]:
+                    old[last_row, i] = state['last_return']
+                in_new = previous_dates >= window_start
+                new[in_new, i] = returns[in_new]
+            added, dropped = _pair_sums(new, new), _pair_sums(old, old)
+            sums = {name: sums[name] + added[name] - dropped[name] for name in _sum_names}
+
+    # New and rescaled tickers, with every ticker over the whole window
+    recalculated = rebased + [ticker for ticker in found if ticker not in tracked.index and ticker in columns]
+    tickers = kept.index.tolist() + recalculated
+    if recalculated:
+        start = dates.searchsorted(window_start)
+        window_returns = np.full((len(dates) - start, len(tickers)), np.nan)
+        for i, ticker in enumerate(tickers):
+            returns, previous_dates = _returns(columns[ticker], date_values, start, len(dates))
+            in_window = previous_dates >= window_start
+            window_returns[in_window, i] = returns[in_window]
+        rows = _pair_sums(window_returns[:, len(kept):], window_returns)
+        cols = _pair_sums(window_returns, window_returns[:, len(kept):])
+        for name in _sum_names:
+            values = np.zeros((len(tickers), len(tickers)))
+            values[:len(kept), :len(kept)] = sums[name]
+            values[len(kept):, :] = rows[name]
+            values[:, len(kept):] = cols[name]
+            sums[name] = values
+
+    states = pd.DataFrame([_ticker_state(columns[ticker], date_values) for ticker in tickers], index=pd.Index(tickers, dtype=object),
+                          columns=['last_date', 'last_return', 'check_date', 'check_close'])
+    states['modified'] = pd.Series(panel['modified'], dtype=np.float64).reindex(tickers).values
+    states['used_at'] = tracked['used_at'].reindex(tickers).values
+    states.loc[states.index.isin(found), 'used_at'] = time.time()
+
+    # Drop the least recently requested tickers beyond max_tickers
+    keep = np.sort(np.argsort(-states['used_at'].fillna(0).values, kind='stable')[:max(max_tickers, len(found))])
+    _state = {
+        'window_start': window_start,
+        'tickers': states.iloc[keep][list(_ticker_columns)],
+        'sums': {name: values[np.ix_(keep, keep)] for name, values in sums.items()},
+    }
+
+def _is_current(panel:dict, found:list, window_start:pd.Timestamp) -> bool:
+    tracked = _state['tickers']
+    return (
+        _state['window_start'] == window_start
+        and all(ticker in tracked.index for ticker in found)
+        and all(panel['modified'].get(ticker) == modified for ticker, modified in tracked['modified'].items())
+    )
+
+def get_moments(tickers:list) -> (pd.Series, pd.DataFrame, set, set):
+    """
+    Returns the mean daily returns and the covariance matrix of the tickers and
+    the Market, read from the running sums, the tickers that could not be
+    found and the ragged tickers. Only the days whose prices changed since the
+    last update, and the days that left the window, are read from the price
+    panel.
+
+    Each ticker's returns are measured from its own previous close and each
+    pair is summed over the days both have a return. For tickers with a
+    return on exactly the days the Market has one, these are the moments over
+    the dates all of them and the Market traded, which the key figures use.
+    The others are returned as ragged, their moments depend on the dates the
+    other tickers of a portfolio traded and are read with get_common_moments.
+    """
+    market_ticker = reference_data.market_ticker
+    reference_data.get_market()
+    price_store.update_store(tickers)
+    window_start = pd.Timestamp.now().normalize() - pd.DateOffset(years=price_store.history_years)
+
+    found = [ticker for ticker in dict.fromkeys(tickers + [market_ticker]) if price_store.modified_at(ticker) is not None]
+    # Zero-copy views into the shared price panel, only read where changed
+    panel = price_panel.update(found)
+
+    with _lock:
+        _load()
+        if not _is_current(panel, found, window_start):
+            _update(panel, found, window_start)
+            _save()
+        positions = pd.Series(range(len(_state['tickers'])), index=_state['tickers'].index)
+        found = [ticker for ticker in found if ticker in positions.index and _state['sums']['n'][positions[ticker], positions[ticker]] > 0]
+        positions = positions[found].values
+        n, sum_a, sum_ab = (_state['sums'][name][np.ix_(positions, positions)] for name in _sum_names)
+
+    not_found_tickers = set(tickers).difference(found)
+    labels = [ticker for ticker in tickers if ticker in found] + ['Market']
+    order = [found.index(ticker) for ticker in labels[:-1] + [market_ticker]]
+    n, sum_a, sum_ab = n[np.ix_(order, order)], sum_a[np.ix_(order, order)], sum_ab[np.ix_(order, order)]
+    ragged_tickers = {ticker for i, ticker in enumerate(labels[:-1]) if not n[i, i] == n[i, -1] == n[-1, -1]}
+
+    mean_daily_returns = pd.Series(np.diag(sum_a) / np.diag(n), index=labels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance_matrix = np.where(n > 1, (sum_ab - sum_a*sum_a.T/n) / (n - 1), np.nan)
+    covariance_matrix = pd.DataFrame(covariance_matrix, index=labels, columns=labels)
+    return mean_daily_returns, covariance_matrix, not_found_tickers, ragged_tickers
+
+def get_common_moments(tickers:list) -> (pd.Series, pd.DataFrame):
+    """
+    Returns the mean daily returns and the covariance matrix of the tickers and
+    the Market over the dates all of them traded, calculated from the prices
+    in the panel like get_raw_price_data does. Tickers the panel does not have
+    are left out.
+    """
+    market_ticker = reference_data.market_ticker
+    dates, columns = price_panel.get_columns(tickers + [market_ticker])
+    labels = [ticker for ticker in dict.fromkeys(tickers) if ticker in columns and ticker != market_ticker]
+    closes = np.column_stack([columns[ticker] for ticker in labels + [market_ticker]])
+    closes = closes[~np.isnan(closes).any(axis=1)]
+    returns = closes[1:] / closes[:-1] - 1
+    labels = labels + ['Market']
+    mean_daily_returns = pd.Series(returns.mean(axis=0), index=labels)
+    covariance_matrix = pd.DataFrame(np.cov(returns, rowvar=False, ddof=1).reshape(len(labels), len(labels)), index=labels, columns=labels)
+    return mean_daily_returns, covariance_matrix
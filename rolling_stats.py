@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import fcntl
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from dotenv import load_dotenv
+
+import price_panel
+import price_store
+import reference_data
+
+load_dotenv()
+
+# Rolling windows in trading days, about one month, one quarter and one year
+windows = (21, 63, 252)
+statistics = ('volatility', 'beta', 'correlation')
+
+# Rolling statistics of every ticker against the Market over the Market's
+# trading dates, cached next to the price panel in the same way: one Arrow
+# IPC file mapped by every worker, with a float64 column per ticker,
+# statistic and window, swapped for a new file when prices change.
+stats_path = os.path.join(price_store.store_dir, 'rolling.arrow')
+lock_path = f'{stats_path}.lock'
+# The least recently requested tickers are dropped beyond this many
+max_tickers = int(os.getenv('ROLLING_STATS_MAX_TICKERS', 1000))
+# Changed with the definition of the statistics, a cache of another version
+# is recalculated as if no ticker was cached
+version = 2
+
+_cache = {'file_id': None, 'dates': pd.DatetimeIndex([]), 'columns': {}, 'modified': {}, 'used': {}}
+
+def column_name(ticker:str, statistic:str, window:int) -> str:
+    return f'{ticker}/{statistic}_{window}'
+
+def rolling_moments(returns:np.ndarray, market_returns:np.ndarray, windows:tuple=windows) -> dict:
+    """
+    Returns, for each window, the rolling volatility, on the one month scale
+    of the key figures, and the beta, as in the key figures, and the
+    correlation against the Market of
+    each column of the (days, assets) returns over the window ending on each
+    day. NaN returns are left out, and a window without window valid returns
+    gives NaN.
+
+    Window sums are differences of cumulative sums taken once for all
+    windows, so the cost is linear in the number of days whatever the
+    windows. Returns are centered first, which keeps the differences accurate
+    over long histories.
+    """
+    valid = ~np.isnan(returns) & ~np.isnan(market_returns)[:, None]
+    a = np.where(valid, returns - np.nanmean(returns, axis=0), 0.0)
+    m = np.where(valid, (market_returns - np.nanmean(market_returns))[:, None], 0.0)
+    zeros = np.zeros((1, a.shape[1]))
+    cumulative = {name: np.concatenate([zeros, np.cumsum(x, axis=0)]) for name, x in
+                  [('n', valid.astype(np.float64)), ('a', a), ('m', m), ('aa', a*a), ('mm', m*m), ('am', a*m)]}
+
+    moments = {}
+    for window in windows:
+        sums = {}
+        for name, values in cumulative.items():
+            sums[name] = np.full(a.shape, np.nan)
+            sums[name][window - 1:] = values[window:] - values[:-window]
+        n = sums['n']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variances = (sums['aa'] - sums['a']*sums['a']/n) / (n - 1)
+            market_variances = (sums['mm'] - sums['m']*sums['m']/n) / (n - 1)
+            covariances = (sums['am'] - sums['a']*sums['m']/n) / (n - 1)
+            full = n == window
+            correlations = covariances / np.sqrt(variances * market_variances)
+            moments[window] = (
+                np.where(full, np.sqrt(variances.clip(min=0)) * np.sqrt(21), np.nan),
+                # The beta of the key figures table, see ETL.calculate_asset_figures
+                np.where(full, correlations * (variances / market_variances), np.nan),
+                np.where(full, correlations, np.nan),
+            )
+    return moments
+
+def _load() -> dict:
+    global _cache
+    try:
+        stat = os.stat(stats_path)
+    except FileNotFoundError:
+        return _cache
+    file_id = (stat.st_ino, stat.st_mtime_ns)
+    if file_id == _cache['file_id']:
+        return _cache
+    table = pa.ipc.open_file(pa.memory_map(stats_path)).read_all()
+    current = table.schema.metadata.get(b'version') == str(version).encode()
+    _cache = {
+        'file_id': file_id,
+        'dates': pd.DatetimeIndex(table.column('date').to_numpy()),
+        'columns': {name: table.column(name).chunk(0).to_numpy(zero_copy_only=True) for name in table.column_names if name != 'date'},
+        'modified': json.loads(table.schema.metadata[b'modified']) if current else {},
+        'used': json.loads(table.schema.metadata.get(b'used', b'{}')) if current else {},
+    }
+    return _cache
+
+def aligned_prices(tickers:list, panel:dict=None) -> pd.DataFrame:
+    """
+    Returns the whole history of the Market, under 'Market', and of the
+    tickers over the Market's trading dates, each ticker carried forward over
+    the dates it did not trade, as its rolling statistics are measured. Reads
+    the current panel unless one returned by price_panel.update is given.
+    """
+    market = price_panel.read_ticker(reference_data.market_ticker, panel).dropna()
+    prices = {ticker: price_panel.read_ticker(ticker, panel).reindex(market.index).ffill() for ticker in tickers}
+    return pd.DataFrame({'Market': market, **prices}, index=market.index, columns=['Market', *tickers])
+
+def _write(cache:dict, panel:dict, tickers:list, modified:dict, used:dict):
+    """
+    Calculates the statistics of the tickers from the panel returned by
+    price_panel.update, which holds them even if they are evicted meanwhile,
+    with the prices of each carried forward over the Market dates it did not
+    trade, and writes them with the columns of the other cached tickers in
+    used, which are copied as they are. modified holds the store mtime of
+    every written ticker and the Market.
+    """
+    prices = aligned_prices(tickers, panel)
+    market = prices['Market']
+    prices = prices[tickers].to_numpy()
+    returns = prices[1:] / prices[:-1] - 1
+    market_returns = market.to_numpy()[1:] / market.to_numpy()[:-1] - 1
+
+    columns = {
+        column_name(ticker, statistic, window): cache['columns'][column_name(ticker, statistic, window)]
+        for ticker in used if ticker not in tickers for statistic in statistics for window in windows
+    }
+    for window, moments in rolling_moments(returns, market_returns).items():
+        for statistic, values in zip(statistics, moments):
+            values = np.concatenate([np.full((1, len(tickers)), np.nan), values])
+            columns.update({column_name(ticker, statistic, window): values[:, i] for i, ticker in enumerate(tickers)})
+    table = pa.table({'date': market.index.values, **columns}, metadata={'modified': json.dumps(modified), 'used': json.dumps(used), 'version': str(version)})
+
+    os.makedirs(os.path.dirname(stats_path), exist_ok=True)
+    tmp_path = f'{stats_path}.{os.getpid()}.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_path, stats_path)
+
+def get_rolling_stats(tickers:list) -> pd.DataFrame:
+    """
+    Returns the rolling statistics of the tickers over the Market dates of the
+    history window, with (ticker, statistic_window) columns, e.g. ('AAPL',
+    'beta_63'). Of the requested tickers only those whose prices changed are
+    recalculated, and the columns of the other cached tickers are copied.
+    When the Market changes, every cached beta and correlation is out of
+    date, so only the requested tickers are kept. Tickers that could not be
+    found are left out.
+    """
+    market_ticker = reference_data.market_ticker
+    reference_data.get_market()
+    price_store.update_store(tickers)
+    panel = price_panel.update(tickers + [market_ticker])
+    modified = {ticker: price_store.modified_at(ticker) for ticker in dict.fromkeys(tickers + [market_ticker])}
+    modified = {ticker: modified_time for ticker, modified_time in modified.items() if modified_time is not None}
+
+    cache = _load()
+    if market_ticker in modified and any(cache['modified'].get(ticker) != modified_time for ticker, modified_time in modified.items()):
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another worker may have updated the cache while this one waited
+            cache = _load()
+            stale = [ticker for ticker, modified_time in modified.items() if cache['modified'].get(ticker) != modified_time]
+            if stale:
+                requested = [ticker for ticker in modified if ticker != market_ticker]
+                market_changed = market_ticker in stale
+                kept = {} if market_changed else {ticker: used_at for ticker, used_at in cache['used'].items() if ticker not in requested}
+                now = time.time()
+                used = dict(sorted({**kept, **{ticker: now for ticker in requested}}.items(), key=lambda item: -item[1])[:max(max_tickers, len(requested))])
+                recalculated = requested if market_changed else [ticker for ticker in requested if ticker in stale]
+                written = {ticker: cache['modified'][ticker] for ticker in used if ticker not in recalculated}
+                written.update({ticker: modified[ticker] for ticker in recalculated + [market_ticker]})
+                _write(cache, panel, recalculated, written, used)
+                cache = _load()
+
+    window_start = pd.Timestamp.now().normalize() - pd.DateOffset(years=price_store.history_years)
+    window = slice(cache['dates'].searchsorted(window_start), None)
+    columns = {
+        (ticker, f'{statistic}_{window_days}'): cache['columns'][column_name(ticker, statistic, window_days)][window]
+        for ticker in dict.fromkeys(tickers) if ticker != market_ticker and column_name(ticker, statistics[0], windows[0]) in cache['columns']
+        for statistic in statistics for window_days in windows
+    }
+    return pd.DataFrame(columns, index=cache['dates'][window])
@@ -0,0 +1,79 @@
+import os
+import time
+import disk_cache
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# The current portfolio of each session, kept on the server so the browser
+# only sends its session id and the change it makes. Shared by all gunicorn
+# workers and background jobs.
+store_dir = os.getenv('SESSION_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.session_store'))
+# Sessions not used for this long are evicted
+idle_seconds = float(os.getenv('SESSION_IDLE_SECONDS', 2 * 3600))
+# Least recently used sessions are evicted above this many bytes
+size_limit = int(os.getenv('SESSION_STORE_SIZE_LIMIT', 64 * 2**20))
+
+store = disk_cache.Cache(store_dir, eviction_policy='least-recently-used', size_limit=size_limit)
+
+def _read(session_id:str) -> (np.ndarray, np.ndarray):
+    # Tickers and amounts are kept as two arrays in insertion order
+    return store.get(session_id, (np.array([], dtype=str), np.array([], dtype=np.int64)))
+
+def _write(session_id:str, tickers:np.ndarray, amounts:np.ndarray):
+    store.set(session_id, (tickers, amounts), expire=idle_seconds)
+
+def get_amounts(session_id:str) -> pd.Series:
+    """
+    Returns the purchase amounts of the current portfolio indexed by ticker.
+    """
+    tickers, amounts = _read(session_id)
+    if len(tickers):
+        store.touch(session_id, expire=idle_seconds)
+    return pd.Series(amounts, index=pd.Index(tickers), name='Amount', dtype=np.int64)
+
+def add_asset(session_id:str, ticker:str, amount:int):
+    with store.transact():
+        tickers, amounts = _read(session_id)
+        if ticker in tickers:
+            amounts = amounts.copy()
+            amounts[tickers == ticker] += amount
+        else:
+            tickers = np.append(tickers, ticker)
+            amounts = np.append(amounts, np.int64(amount))
+        _write(session_id, tickers, amounts)
+
+def delete_asset(session_id:str, ticker:str):
+    with store.transact():
+        tickers, amounts = _read(session_id)
+        kept = tickers != ticker
+        _write(session_id, tickers[kept], amounts[kept])
+
+def clear(session_id:str):
+    store.delete(session_id)
+
+def get_version(session_id:str) -> int:
+    """
+    Returns the version of the session's saved portfolios, which processes
+    caching them compare against. Kept apart from the current portfolio so
+    that clearing it does not reset the version.
+
+    Versions are nanosecond timestamps. A session without one, also after it
+    was evicted, is given a new one, so no version is ever handed out twice
+    and an entry cached before an eviction cannot match again.
+    """
+    key = f'version/{session_id}'
+    version = store.get(key)
+    if version is None:
+        version = time.time_ns()
+        # Another process may have given the session its version first
+        if not store.add(key, version, expire=idle_seconds):
+            version = store.get(key, version)
+    return version
+
+def bump_version(session_id:str):
+    key = f'version/{session_id}'
+    with store.transact():
+        store.set(key, max(store.get(key, 0) + 1, time.time_ns()), expire=idle_seconds)
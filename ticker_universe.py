@@ -0,0 +1,160 @@
+import os
+import sys
+import threading
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+import price_store
+
+load_dotenv()
+
+# Symbols the ticker input accepts, with their name, exchange and first
+# trading date, written by `python ticker_universe.py build`. Without the file
+# every ticker is accepted and left for the download to find.
+universe_path = os.getenv('TICKER_UNIVERSE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ticker_universe.parquet'))
+# Symbol directories of all US listed securities from nasdaqtrader.com, used
+# when build is given no sources
+default_sources = [
+    'https://www.nasdaqtrader.com/dynamic/SymDir/nasdaqlisted.txt',
+    'https://www.nasdaqtrader.com/dynamic/SymDir/otherlisted.txt',
+]
+exchange_names = {'A': 'NYSE American', 'N': 'NYSE', 'P': 'NYSE Arca', 'Z': 'Cboe BZX', 'V': 'IEX'}
+# Suggestions shown while a ticker is typed
+max_suggestions = int(os.getenv('TICKER_SUGGESTIONS', 10))
+
+_lock = threading.Lock()
+_index = None
+_loaded_mtime = None
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _load() -> dict:
+    """
+    Returns the prefix index, sorted arrays of the tickers and of the upper
+    case names searched with binary search, reading the universe file again if
+    it changed since. Returns None if there is no universe.
+    """
+    global _index, _loaded_mtime
+    if not os.path.exists(universe_path):
+        return None
+    mtime = os.path.getmtime(universe_path)
+    if mtime != _loaded_mtime:
+        with _lock:
+            if mtime != _loaded_mtime:
+                frame = pd.read_parquet(universe_path).sort_values('ticker').reset_index(drop=True)
+                name_keys = frame['name'].fillna('').str.upper().values.astype(str)
+                name_order = np.argsort(name_keys, kind='stable')
+                _index = {
+                    'tickers': frame['ticker'].values.astype(str),
+                    'names': frame['name'].fillna('').values,
+                    'exchanges': frame['exchange'].fillna('').values,
+                    'first_trading_dates': pd.to_datetime(frame['first_trading_date']).values,
+                    'name_keys': name_keys[name_order],
+                    'name_rows': name_order,
+                }
+                _loaded_mtime = mtime
+    return _index
+
+def _prefix_range(keys:np.ndarray, prefix:str) -> (int, int):
+    return keys.searchsorted(prefix), keys.searchsorted(prefix + '\uffff')
+
+def lookup(ticker:str) -> dict:
+    """
+    Returns the ticker, name, exchange and first trading date (None if not
+    known) of a symbol in the universe, or None.
+    """
+    index = _load()
+    if index is None:
+        return None
+    i = index['tickers'].searchsorted(ticker)
+    if i == len(index['tickers']) or index['tickers'][i] != ticker:
+        return None
+    first_trading_date = index['first_trading_dates'][i]
+    return {
+        'ticker': ticker,
+        'name': index['names'][i],
+        'exchange': index['exchanges'][i],
+        'first_trading_date': None if pd.isna(first_trading_date) else pd.Timestamp(first_trading_date),
+    }
+
+def is_known(ticker:str) -> bool:
+    """
+    Returns whether the ticker is in the universe, or True if there is none.
+    """
+    return _load() is None or lookup(ticker) is not None
+
+def complete(prefix:str, limit:int=max_suggestions) -> list:
+    """
+    Returns up to limit (ticker, name) pairs of the symbols starting with the
+    prefix, followed by those whose name starts with it.
+
+    example: complete('AAP') -> [('AAP', 'Advance Auto Parts Inc.'), ('AAPL', 'Apple Inc. - Common Stock'), ...]
+    """
+    index = _load()
+    prefix = (prefix or '').strip().upper()
+    if index is None or not prefix:
+        return []
+    start, end = _prefix_range(index['tickers'], prefix)
+    rows = list(range(start, min(end, start + limit)))
+    if len(rows) < limit:
+        start, end = _prefix_range(index['name_keys'], prefix)
+        for row in index['name_rows'][start:end]:
+            if len(rows) == limit:
+                break
+            if row not in rows:
+                rows.append(row)
+    return [(index['tickers'][row], index['names'][row]) for row in rows]
+
+def _read_source(source:str) -> pd.DataFrame:
+    """
+    Reads a nasdaqtrader.com symbol directory file, or a CSV with ticker,
+    name, exchange and optionally first_trading_date columns, from a path or
+    URL. Symbols are converted to the Yahoo Finance format.
+    """
+    if not source.endswith('.txt'):
+        frame = pd.read_csv(source, dtype=str)
+        frame['first_trading_date'] = pd.to_datetime(frame.get('first_trading_date'))
+        return frame[['ticker', 'name', 'exchange', 'first_trading_date']]
+
+    frame = pd.read_csv(source, sep='|', dtype=str, keep_default_na=False)
+    # The last line is the creation time of the file
+    frame = frame[~frame.iloc[:, 0].str.startswith('File Creation Time') & (frame['Test Issue'] == 'N')]
+    if 'Symbol' in frame.columns:
+        symbols, exchanges = frame['Symbol'], 'NASDAQ'
+    else:
+        symbols, exchanges = frame['ACT Symbol'], frame['Exchange'].map(exchange_names)
+    # Share classes are BRK.B there and BRK-B on Yahoo, preferred shares BAC$L and BAC-PL
+    symbols = symbols.str.replace('.', '-', regex=False).str.replace('$', '-P', regex=False)
+    return pd.DataFrame({'ticker': symbols, 'name': frame['Security Name'], 'exchange': exchanges, 'first_trading_date': pd.NaT})
+
+def build(sources:list=None) -> pd.DataFrame:
+    """
+    Writes the universe from the sources, the default_sources if None. A
+    ticker in several sources takes the values of the last one. Tickers the
+    sources give no first trading date are dated from the price store, if
+    their stored history shows they started trading within the window.
+    """
+    frame = pd.concat([_read_source(source) for source in sources or default_sources])
+    frame['ticker'] = frame['ticker'].str.strip().str.upper()
+    frame = frame[frame['ticker'] != ''].drop_duplicates('ticker', keep='last').sort_values('ticker').reset_index(drop=True)
+    frame['first_trading_date'] = pd.to_datetime(frame['first_trading_date'])
+    undated = frame['first_trading_date'].isna()
+    frame.loc[undated, 'first_trading_date'] = pd.to_datetime([price_store.first_trading_date(ticker) for ticker in frame.loc[undated, 'ticker']])
+
+    # Write to a temporary file first so workers never read a partial file
+    tmp_path = f'{universe_path}.{os.getpid()}.tmp'
+    frame.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, universe_path)
+    return frame
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['build']:
+        print('usage: python ticker_universe.py build [source ...]')
+        sys.exit(1)
+    universe = build(sys.argv[2:] or None)
+    print(f'{len(universe)} tickers written to {universe_path}')